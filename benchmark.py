@@ -22,76 +22,1299 @@ it. You can run this script from anywhere, just use checkbox-ng's path as the
 argument. If you don't have access to the Internet from where the script is run
 then use --provider-repository option to point to a benchmarking-provider git
 tree.
+
+Every scenario is run locally and remotely, --warmup times unmeasured and then
+--repeat times, and statistics of the measured runs are reported. The setup is
+cached between runs of the same checkbox-ng tree. See --help for saving and
+comparing results, running scenarios in parallel, synthetic providers and the
+optional breakdowns. --phases and --tracemalloc slow checkbox-cli down, so
+timings taken with them are only good for comparing with each other.
 """
 
 import argparse
+import concurrent.futures
 import contextlib
+import fcntl
 import glob
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import multiprocessing.util
 import os
+import platform
+import random
+import re
+import resource
+import shlex
 import shutil
 import signal
+import socket
+import statistics
 import subprocess
-import sys
 import tempfile
+import threading
 import time
 
 from pprint import pprint
 
 
+# Port of the slaves, None for the default one. Every parallel worker sets its
+# own.
+SLAVE_PORT = None
+DEFAULT_SLAVE_PORT = 18871
+FIRST_WORKER_PORT = 18872
+# The slave used by all remote runs with --reuse-slave.
+SLAVE = None
+
+
+# Directory of the cache holding the mirrors of provider repositories.
+MIRRORS_DIR = 'mirrors'
+# Directories left out of the checkbox-ng tree hash.
+IGNORED_DIRS = {'.git', '.tox', '__pycache__', 'venv'}
+
+
+def default_cache_dir():
+    """Return where the benchmark environments are cached by default."""
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'checkbox-benchmark')
+
+
+def tree_hash(path):
+    """Hash the contents of the tree at `path`, ignoring build leftovers."""
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(
+            d for d in dirs
+            if d not in IGNORED_DIRS and not d.endswith('.egg-info'))
+        for name in sorted(files):
+            if name.endswith('.pyc'):
+                continue
+            full_path = os.path.join(root, name)
+            digest.update(os.path.relpath(full_path, path).encode() + b'\0')
+            if os.path.islink(full_path):
+                digest.update(os.readlink(full_path).encode())
+            else:
+                with open(full_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(chunk)
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def cached_workdir(cache_dir, checkbox_path, size):
+    """Lock and yield the cache entry of the checkbox-ng tree.
+
+    The entry gets a copy of the tree if it doesn't have one yet. On exit the
+    least recently used entries above `size` are evicted.
+    """
+    entry = os.path.join(cache_dir, tree_hash(checkbox_path))
+    os.makedirs(entry, exist_ok=True)
+    with open(os.path.join(entry, 'lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        os.utime(entry)
+        checkbox_copy = os.path.join(entry, 'checkbox-ng')
+        if not os.path.exists(checkbox_copy):
+            partial = checkbox_copy + '.partial'
+            shutil.rmtree(partial, ignore_errors=True)
+            shutil.copytree(checkbox_path, partial)
+            os.rename(partial, checkbox_copy)
+        else:
+            print("Reusing cached environment {}".format(entry))
+        yield entry
+    evict(cache_dir, size)
+
+
+def evict(cache_dir, size):
+    """Remove all but the `size` most recently used cache entries."""
+    entries = sorted(
+        (os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+         if name != MIRRORS_DIR),
+        key=os.path.getmtime, reverse=True)
+    for entry in entries[size:]:
+        with open(os.path.join(entry, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # in use by another benchmark
+            shutil.rmtree(entry)
+
+
+def update_mirror(repository, mirrors_dir, offline):
+    """Return a local bare mirror of `repository`, fetched unless offline."""
+    mirror = os.path.join(mirrors_dir, '{}.git'.format(
+        hashlib.sha1(repository.encode()).hexdigest()[:16]))
+    if not os.path.exists(mirror):
+        if offline:
+            raise SystemExit("There's no mirror of {} to use offline".format(
+                repository))
+        partial = mirror + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        print("Mirroring {}".format(repository))
+        try:
+            subprocess.run(
+                ['git', 'clone', '-q', '--mirror', repository, partial],
+                check=True)
+        except subprocess.CalledProcessError:
+            raise SystemExit("Failed to mirror {}".format(repository))
+        os.rename(partial, mirror)
+    elif not offline:
+        fetch = subprocess.run(['git', 'fetch', '-q', '--prune'], cwd=mirror)
+        if fetch.returncode:
+            print("WARNING: failed to update the mirror of {}, using it as "
+                  "it is".format(repository))
+    return mirror
+
+
+def is_git_repository(path):
+    """Tell whether `path` is a git working tree or a bare repository."""
+    return (os.path.exists(os.path.join(path, '.git')) or
+            os.path.exists(os.path.join(path, 'objects')) and
+            os.path.exists(os.path.join(path, 'HEAD')))
+
+
+def fetch_provider(repository, path):
+    """Clone or update the provider at `path`, return its commit.
+
+    If `repository` is a plain directory it's copied instead and the hash of
+    its tree takes the place of the commit.
+    """
+    if os.path.isdir(repository) and not is_git_repository(repository):
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.copytree(repository, path, symlinks=True)
+        return 'tree-{}'.format(tree_hash(path))
+    if not is_git_repository(path):
+        shutil.rmtree(path, ignore_errors=True)
+        subprocess.run(['git', 'clone', '-q', repository, path], check=True)
+    else:
+        subprocess.run(
+            ['git', 'fetch', '-q', repository, 'HEAD'], cwd=path, check=True)
+        subprocess.run(
+            ['git', 'checkout', '-q', '--detach', 'FETCH_HEAD'], cwd=path,
+            check=True)
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=path,
+        universal_newlines=True).strip()
+
+
+def ensure_venv(venv_path):
+    """Prepare the venv at `venv_path` unless a complete one is there."""
+    ready = os.path.join(venv_path, '.benchmark-ready')
+    if os.path.exists(ready):
+        return
+    shutil.rmtree(venv_path, ignore_errors=True)
+    prepare_venv(venv_path)
+    open(ready, 'w').close()
+
+
+SYNTHETIC_NAMESPACE = '2021.com.canonical.certification'
+SYNTHETIC_MANAGE_PY = """\
+#!/usr/bin/env python3
+from plainbox.provider_manager import setup, N_
+
+setup(
+    name='{namespace}:synthetic-benchmark',
+    version="1.0",
+    description=N_("Synthetic provider for benchmarking"),
+)
+"""
+SYNTHETIC_LAUNCHER = """\
+#!/usr/bin/env checkbox-cli
+[launcher]
+app_id = com.canonical.certification:synthetic-benchmark
+launcher_version = 1
+stock_reports = none
+
+[test plan]
+unit = {namespace}::synthetic_plan_0
+forced = yes
+
+[test selection]
+forced = yes
+
+[ui]
+type = silent
+"""
+
+
+def size_list(value):
+    """Parse a comma-separated list of positive integers."""
+    try:
+        sizes = [int(size) for size in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a list of integers")
+    if min(sizes) < 1:
+        raise argparse.ArgumentTypeError("sizes must be positive")
+    return sizes
+
+
+def generate_provider(path, jobs, test_plans, fanout, depth):
+    """Write a synthetic provider and a launcher for its first test plan.
+
+    Every `fanout` consecutive jobs require the same resource job, every
+    `depth` consecutive jobs form a dependency chain and whole chains are
+    dealt to the test plans in turn.
+    """
+    chains = math.ceil(jobs / depth)
+    if chains < test_plans:
+        raise SystemExit(
+            "{} jobs in chains of {} can't fill {} test plans".format(
+                jobs, depth, test_plans))
+    units = os.path.join(path, 'provider', 'units')
+    os.makedirs(units)
+    manage_py = os.path.join(path, 'provider', 'manage.py')
+    with open(manage_py, 'wt') as f:
+        f.write(SYNTHETIC_MANAGE_PY.format(namespace=SYNTHETIC_NAMESPACE))
+    os.chmod(manage_py, 0o755)
+    plans = [[] for _ in range(test_plans)]
+    with open(os.path.join(units, 'jobs.pxu'), 'wt') as f:
+        for resource_index in range(math.ceil(jobs / fanout)):
+            f.write(
+                "unit: job\n"
+                "id: synthetic_resource_{}\n"
+                "plugin: resource\n"
+                "flags: simple\n"
+                "command: echo 'ready: yes'\n\n".format(resource_index))
+        for job in range(jobs):
+            f.write(
+                "unit: job\n"
+                "id: synthetic_job_{}\n"
+                "plugin: shell\n"
+                "flags: simple\n"
+                "command: true\n"
+                "requires: synthetic_resource_{}.ready == 'yes'\n".format(
+                    job, job // fanout))
+            if job % depth:
+                f.write("depends: synthetic_job_{}\n".format(job - 1))
+            f.write("\n")
+            plans[job // depth % test_plans].append(job)
+    with open(os.path.join(units, 'test-plans.pxu'), 'wt') as f:
+        for plan, plan_jobs in enumerate(plans):
+            f.write(
+                "unit: test plan\n"
+                "id: synthetic_plan_{0}\n"
+                "_name: Synthetic test plan {0}\n"
+                "include:\n".format(plan))
+            for job in plan_jobs:
+                f.write(" synthetic_job_{}\n".format(job))
+            f.write("\n")
+    with open(os.path.join(path, 'launcher'), 'wt') as f:
+        f.write(SYNTHETIC_LAUNCHER.format(namespace=SYNTHETIC_NAMESPACE))
+
+
+def develop_provider(path):
+    """Develop the synthetic provider in `path` into its providers dir."""
+    providers = os.path.join(path, 'providers')
+    os.makedirs(providers, exist_ok=True)
+    try:
+        subprocess.run(
+            ". venv/bin/activate; {} develop -d {}".format(
+                shlex.quote(os.path.join(path, 'provider', 'manage.py')),
+                shlex.quote(providers)),
+            shell=True, stdout=subprocess.DEVNULL, check=True)
+    except subprocess.CalledProcessError:
+        raise SystemExit("Failed to develop the provider in {}".format(path))
+
+
+def activate(launcher=None):
+    """Return the shell command activating the venv to run `launcher`.
+
+    A launcher with a providers directory next to it, as the synthetic ones
+    have, only gets to see the providers in there.
+    """
+    command = '. venv/bin/activate'
+    if launcher:
+        providers = os.path.join(os.path.dirname(launcher), 'providers')
+        if os.path.isdir(providers):
+            command += '; export PROVIDERPATH={}'.format(
+                shlex.quote(providers))
+    return command
+
+
 def prepare_venv(venv_path):
     """Create venv and develop the benchmarking provider in it."""
-    os.chdir('checkbox-ng')
     subprocess.run(
-        ['./mk-venv', venv_path],
+        ['./mk-venv', venv_path], cwd='checkbox-ng',
         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
     manage_py = os.path.join('benchmarking-provider', 'manage.py')
-    os.chdir('..')
     subprocess.run(
         ". {}; {} develop -d $PROVIDERPATH".format(
-            os.path.join('venv', 'bin', 'activate'), manage_py),
+            os.path.join(venv_path, 'bin', 'activate'), manage_py),
         shell=True, stdout=subprocess.DEVNULL, check=True)
 
 
-def run_via_remote(launcher):
-    """Launch a slave and run `launcher` via master on that slave."""
+# Phases recognized in the debug log, the first matching pattern wins. A log
+# line starts its phase, which then lasts until a line of another phase.
+PHASE_MARKERS = [
+    ('checkpoint', re.compile(r'checkpoint', re.IGNORECASE)),
+    ('bootstrap', re.compile(r'bootstrap', re.IGNORECASE)),
+    ('providers', re.compile(r'provider', re.IGNORECASE)),
+    ('jobs', re.compile(r'\bjob\b|running', re.IGNORECASE)),
+]
+PHASES = ['startup', 'import', 'providers', 'bootstrap', 'jobs', 'checkpoint']
+RE_CONNECT = re.compile(r'connect', re.IGNORECASE)
+RE_IMPORT_TIME = re.compile(
+    r'^import time:\s+(\d+) \|\s+(\d+) \| (.*)$')
+
+
+def phase_breakdown(timeline, total):
+    """Split `total` among phases, given lines timestamped on arrival."""
+    phases = dict.fromkeys(PHASES, 0.0)
+    imports_done = False
+    current = None
+    since = None
+    for stamp, line in timeline:
+        if line.startswith('import time:'):
+            match = RE_IMPORT_TIME.match(line)
+            # only the imports of checkbox-cli itself, not of the jobs
+            if (match and not imports_done and
+                    not match.group(3).startswith(' ')):
+                phases['import'] += int(match.group(2)) / 1e6
+            continue
+        imports_done = True
+        phase = next(
+            (name for name, marker in PHASE_MARKERS if marker.search(line)),
+            None)
+        if phase is None or phase == current:
+            continue
+        if current is None:
+            phases['startup'] = max(0.0, stamp - phases['import'])
+        else:
+            phases[current] += stamp - since
+        current, since = phase, stamp
+    if current is None:
+        phases['startup'] = max(0.0, total - phases['import'])
+    else:
+        phases[current] += total - since
+    return phases
+
+
+class ResourceMonitor:
+    """Sample resource usage of process trees from /proc in a thread.
+
+    Counters (CPU time, context switches and block I/O) are summed over the
+    last sample of every process of a tree, minus what the tree had used when
+    it started being watched. Peak RSS and the number of open file
+    descriptors are the high-water marks of the whole tree.
+    """
+
+    COUNTERS = ['user_cpu', 'sys_cpu', 'voluntary_ctx_switches',
+                'involuntary_ctx_switches', 'block_input', 'block_output']
+
+    def __init__(self, interval=0.01):
+        self._interval = interval
+        self._roots = {}
+        self._counters = {}
+        self._baselines = {}
+        self._peaks = {}
+        self._overrides = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._ticks = os.sysconf('SC_CLK_TCK')
+
+    def start(self):
+        """Start sampling."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling, taking one last sample."""
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._thread.join()
+            self._sample()
+
+    def watch(self, name, pid):
+        """Track the process tree rooted at `pid` under `name`."""
+        with self._lock:
+            self._roots[name] = pid
+            self._counters[name] = {}
+            self._baselines[name] = dict.fromkeys(self.COUNTERS, 0)
+            for tree_pid in self._tree(pid):
+                sample = self._read(tree_pid)
+                if sample is not None:
+                    for counter, value in sample[0].items():
+                        self._baselines[name][counter] += value
+            self._peaks[name] = {'peak_rss_kb': 0, 'max_fds': 0}
+
+    def override(self, name, usage):
+        """Replace sampled values of `name` with more precise ones."""
+        self._overrides[name] = usage
+
+    def report(self):
+        """Return resource usage of every watched tree."""
+        report = {}
+        for name in self._roots:
+            usage = {
+                counter: -value
+                for counter, value in self._baselines[name].items()}
+            for counters in self._counters[name].values():
+                for counter, value in counters.items():
+                    usage[counter] += value
+            usage.update(self._peaks[name])
+            overrides = dict(self._overrides.get(name, {}))
+            usage['peak_rss_kb'] = max(
+                usage['peak_rss_kb'], overrides.pop('peak_rss_kb', 0))
+            usage.update(overrides)
+            report[name] = usage
+        return report
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._sample()
+
+    def _sample(self):
+        with self._lock:
+            for name, root in self._roots.items():
+                rss = fds = 0
+                for pid in self._tree(root):
+                    sample = self._read(pid)
+                    if sample is None:
+                        continue
+                    counters, pid_rss, pid_hwm, pid_fds = sample
+                    self._counters[name][pid] = counters
+                    rss += pid_rss
+                    fds += pid_fds
+                    peaks = self._peaks[name]
+                    peaks['peak_rss_kb'] = max(peaks['peak_rss_kb'], pid_hwm)
+                peaks = self._peaks[name]
+                peaks['peak_rss_kb'] = max(peaks['peak_rss_kb'], rss)
+                peaks['max_fds'] = max(peaks['max_fds'], fds)
+
+    @staticmethod
+    def _tree(root):
+        pending = [root]
+        while pending:
+            pid = pending.pop()
+            yield pid
+            with contextlib.suppress(OSError):
+                for task in os.listdir('/proc/{}/task'.format(pid)):
+                    with open('/proc/{}/task/{}/children'.format(
+                            pid, task)) as f:
+                        pending.extend(map(int, f.read().split()))
+
+    def _read(self, pid):
+        proc = '/proc/{}'.format(pid)
+        try:
+            with open(os.path.join(proc, 'stat')) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            status = {}
+            with open(os.path.join(proc, 'status')) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    status[key] = value.split()
+            fds = len(os.listdir(os.path.join(proc, 'fd')))
+        except (OSError, IndexError):
+            return None
+        io = {}
+        with contextlib.suppress(OSError):
+            with open(os.path.join(proc, 'io')) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    io[key] = int(value)
+        counters = {
+            'user_cpu': int(fields[11]) / self._ticks,
+            'sys_cpu': int(fields[12]) / self._ticks,
+            'voluntary_ctx_switches': int(
+                status.get('voluntary_ctxt_switches', [0])[0]),
+            'involuntary_ctx_switches': int(
+                status.get('nonvoluntary_ctxt_switches', [0])[0]),
+            # the same 512 byte units getrusage uses
+            'block_input': io.get('read_bytes', 0) // 512,
+            'block_output': io.get('write_bytes', 0) // 512,
+        }
+        rss = int(status.get('VmRSS', [0])[0])
+        hwm = int(status.get('VmHWM', [0])[0])
+        return counters, rss, hwm, fds
+
+
+# Number of allocation sites kept per process, more than are printed so that
+# sites can still be compared with a baseline after moving in the ranking.
+ALLOCATION_SITES = 100
+SITECUSTOMIZE = """\
+# Injected by benchmark.py to trace the memory allocations of checkbox-cli
+# and the traffic of master with the slave.
+import atexit
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import tracemalloc
+
+_DUMP_DIR = os.environ.get('BENCHMARK_TRACEMALLOC')
+_PROTOCOL_DIR = os.environ.get('BENCHMARK_PROTOCOL')
+
+
+def _dump():
+    if os.path.basename(sys.argv[0]) != 'checkbox-cli':
+        return
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ])
+    sites = {{
+        '{{}}:{{}}'.format(stat.traceback[0].filename,
+                       stat.traceback[0].lineno): [stat.size, stat.count]
+        for stat in snapshot.statistics('lineno')[:{sites}]}}
+    role = 'slave' if sys.argv[1:2] == ['slave'] else 'launcher'
+    path = os.path.join(_DUMP_DIR, '{{}}-{{}}.json'.format(role, os.getpid()))
+    with open(path, 'w') as f:
+        json.dump({{'role': role, 'peak': peak, 'sites': sites}}, f)
+
+
+if _DUMP_DIR:
+    tracemalloc.start()
+    atexit.register(_dump)
+    # the slave is stopped with SIGTERM, let it exit through atexit
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(128 + 15))
+
+
+# sockets connected to the slave, each mapped to when the oldest request
+# sent over it that isn't answered yet was sent
+_slave_sockets = {{}}
+_connects = []
+_round_trips = []
+
+
+def _wrap(name, wrapper):
+    original = getattr(socket.socket, name)
+    setattr(socket.socket, name, lambda sock, *args, **kwargs: wrapper(
+        sock, original, *args, **kwargs))
+
+
+def _connect(sock, original, address, *args, **kwargs):
+    start = time.perf_counter()
+    result = original(sock, address, *args, **kwargs)
+    if isinstance(address, tuple) and address[1] == _SLAVE_PORT:
+        _connects.append(time.perf_counter() - start)
+        _slave_sockets[sock] = None
+    return result
+
+
+def _send(sock, original, *args, **kwargs):
+    if sock in _slave_sockets and _slave_sockets[sock] is None:
+        _slave_sockets[sock] = time.perf_counter()
+    return original(sock, *args, **kwargs)
+
+
+def _recv(sock, original, *args, **kwargs):
+    result = original(sock, *args, **kwargs)
+    if result and _slave_sockets.get(sock) is not None:
+        _round_trips.append(time.perf_counter() - _slave_sockets[sock])
+        _slave_sockets[sock] = None
+    return result
+
+
+def _dump_protocol():
+    if sys.argv[1:2] != ['master']:
+        return
+    path = os.path.join(_PROTOCOL_DIR, 'master-{{}}.json'.format(os.getpid()))
+    with open(path, 'w') as f:
+        json.dump({{'connects': _connects, 'round_trips': _round_trips}}, f)
+
+
+if _PROTOCOL_DIR:
+    _SLAVE_PORT = int(os.environ['BENCHMARK_SLAVE_PORT'])
+    _wrap('connect', _connect)
+    for _name in ['send', 'sendall']:
+        _wrap(_name, _send)
+    for _name in ['recv', 'recv_into']:
+        _wrap(_name, _recv)
+    atexit.register(_dump_protocol)
+""".format(sites=ALLOCATION_SITES)
+
+
+def sitecustomize_env(dump_dir):
+    """Prepare the sitecustomize module, return the environment loading it.
+
+    The module and the empty `dump_dir` it dumps to live in the working
+    directory. Dumps of previous runs are removed.
+    """
+    site_dir = os.path.abspath('sitecustomize')
+    os.makedirs(site_dir, exist_ok=True)
+    with open(os.path.join(site_dir, 'sitecustomize.py'), 'wt') as f:
+        f.write(SITECUSTOMIZE)
+    dump_dir = os.path.abspath(dump_dir)
+    shutil.rmtree(dump_dir, ignore_errors=True)
+    os.makedirs(dump_dir)
+    python_path = os.environ.get('PYTHONPATH')
+    return {
+        'PYTHONPATH': site_dir + (':' + python_path if python_path else ''),
+    }
+
+
+def tracing_env():
+    """Prepare tracing allocations, return the environment enabling it."""
+    env = sitecustomize_env('tracemalloc')
+    env['BENCHMARK_TRACEMALLOC'] = os.path.abspath('tracemalloc')
+    return env
+
+
+def protocol_env():
+    """Prepare tracing the traffic of master, return the env enabling it."""
+    env = sitecustomize_env('protocol')
+    env['BENCHMARK_PROTOCOL'] = os.path.abspath('protocol')
+    env['BENCHMARK_SLAVE_PORT'] = str(SLAVE_PORT or DEFAULT_SLAVE_PORT)
+    return env
+
+
+def collect_protocol(env):
+    """Read the traffic dump of master, return its connects and round trips."""
+    for path in glob.glob(os.path.join(env['BENCHMARK_PROTOCOL'], '*')):
+        with open(path, 'rt') as f:
+            return json.load(f)
+    return {'connects': [], 'round_trips': []}
+
+
+def allocation_site(filename):
+    """Make the location of an allocation site comparable between runs."""
+    for marker in ['/site-packages/', '/checkbox-ng/']:
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return filename
+
+
+def collect_allocations(env):
+    """Read the allocation dumps of a run, return them by process role."""
+    allocations = {}
+    for path in glob.glob(os.path.join(env['BENCHMARK_TRACEMALLOC'], '*')):
+        with open(path, 'rt') as f:
+            dump = json.load(f)
+        process = allocations.setdefault(
+            dump['role'], {'peak': 0, 'sites': {}})
+        process['peak'] += dump['peak']
+        for site, (size, count) in dump['sites'].items():
+            site = allocation_site(site)
+            size_before, count_before = process['sites'].get(site, (0, 0))
+            process['sites'][site] = (size_before + size, count_before + count)
+    return allocations
+
+
+def rusage_delta(before, after):
+    """Resource usage of the children reaped between two getrusage calls."""
+    usage = {
+        'user_cpu': after.ru_utime - before.ru_utime,
+        'sys_cpu': after.ru_stime - before.ru_stime,
+        'voluntary_ctx_switches': after.ru_nvcsw - before.ru_nvcsw,
+        'involuntary_ctx_switches': after.ru_nivcsw - before.ru_nivcsw,
+        'block_input': after.ru_inblock - before.ru_inblock,
+        'block_output': after.ru_oublock - before.ru_oublock,
+    }
+    # ru_maxrss is the largest child ever reaped, so it is only known to
+    # belong to this run if it grew
+    if after.ru_maxrss > before.ru_maxrss:
+        usage['peak_rss_kb'] = after.ru_maxrss
+    return usage
+
+
+def execute(command, timeline=None, monitor=None, env=None):
+    """Run shell `command`, return the time it took.
+
+    If `timeline` is a list, the command is run with debug logging and import
+    profiling enabled and its output lines, timestamped on arrival, are
+    appended to `timeline` together with the total time. If `monitor` is
+    given, the command is watched by it as 'launcher'. `env` holds extra
+    environment variables.
+    """
+    env = dict(env or {})
+    if timeline is not None:
+        env.update(
+            PLAINBOX_LOG_LEVEL='DEBUG', PLAINBOX_DEBUG='console',
+            PYTHONPROFILEIMPORTTIME='1', PYTHONUNBUFFERED='1')
+    env = dict(os.environ, **env) if env else None
+    lines = []
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with subprocess.Popen(
+            command, shell=True, env=env,
+            stdout=subprocess.PIPE if timeline is not None else None,
+            stderr=subprocess.STDOUT, universal_newlines=True) as proc:
+        if monitor:
+            monitor.watch('launcher', proc.pid)
+        if timeline is not None:
+            for line in proc.stdout:
+                lines.append((time.perf_counter() - start, line.rstrip('\n')))
+    elapsed = time.perf_counter() - start
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, command, '\n'.join(line for _, line in lines))
+    if monitor:
+        monitor.override('launcher', rusage_delta(
+            before, resource.getrusage(resource.RUSAGE_CHILDREN)))
+    if timeline is not None:
+        timeline.append({'lines': lines, 'elapsed': elapsed})
+    return elapsed
+
+
+def start_slave(launcher=None, env=None):
+    """Start a slave in a session of its own, return its process."""
+    if env:
+        env = dict(os.environ, **env)
     try:
-        slave_proc = subprocess.Popen(
-            '. venv/bin/activate; checkbox-cli slave',
-            shell=True, start_new_session=True)
+        return subprocess.Popen(
+            '{}; checkbox-cli slave{}'.format(
+                activate(launcher),
+                '' if SLAVE_PORT is None else ' --port {}'.format(
+                    SLAVE_PORT)),
+            shell=True, start_new_session=True, env=env)
     except subprocess.CalledProcessError:
         raise SystemExit("Failed to run the slave")
+
+
+def stop_slave(slave_proc, timeout=10):
+    """Kill everything in the session of the slave and wait for it to end."""
+    # the slave leads its own session, so its pid is the process group id
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(slave_proc.pid, signal.SIGTERM)
+    slave_proc.wait()
+    deadline = time.perf_counter() + timeout
+    while group_alive(slave_proc.pid) and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+
+def group_alive(pgid):
+    """Tell whether a process group has processes that aren't zombies.
+
+    Orphaned zombies aren't necessarily reaped right away, so they can't
+    count.
+    """
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        with contextlib.suppress(OSError, IndexError):
+            with open('/proc/{}/stat'.format(pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[2]) == pgid and fields[0] != 'Z':
+                return True
+    return False
+
+
+def probe_connect():
+    """Connect to the slave, raise OSError if it doesn't accept connections."""
+    socket.create_connection(
+        ('localhost', SLAVE_PORT or DEFAULT_SLAVE_PORT), timeout=10).close()
+
+
+def start_reused_slave(timeout=60):
+    """Start the slave used by all remote runs and wait until it listens."""
+    global SLAVE
+    SLAVE = start_slave()
+    start = time.perf_counter()
+    while True:
+        try:
+            probe_connect()
+            break
+        except OSError:
+            if SLAVE.poll() is not None:
+                raise SystemExit("Slave died by its own. Benchmarking failed")
+            if time.perf_counter() - start > timeout:
+                stop_slave(SLAVE)
+                raise SystemExit("Slave doesn't accept connections")
+            time.sleep(0.01)
+    print("Slave started in {:.3f}s".format(time.perf_counter() - start))
+    return SLAVE
+
+
+def run_via_remote(launcher, timeline=None, usage=None, allocations=None,
+                   protocol=None):
+    """Launch a slave and run `launcher` via master on that slave.
+
+    If `protocol` is a list, the connects and the request round trips of
+    master to the slave are traced and appended to it.
+    """
+    env = tracing_env() if allocations is not None else None
+    if protocol is not None:
+        env = protocol_env()
     with contextlib.ExitStack() as stack:
-        def kill_slave(*_):
-            with contextlib.suppress(ProcessLookupError):
-                os.killpg(os.getpgid(slave_proc.pid), signal.SIGTERM)
-        stack.push(kill_slave)
+        if SLAVE is None:
+            slave_proc = start_slave(launcher, env)
+            stack.callback(stop_slave, slave_proc)
+        else:
+            slave_proc = SLAVE
+        monitor = None
+        if usage is not None:
+            monitor = ResourceMonitor()
+            monitor.watch('slave', slave_proc.pid)
+            monitor.start()
+            stack.callback(monitor.stop)
         try:
-            start = time.time()
-            subprocess.run(
-                ". venv/bin/activate; checkbox-cli master localhost {}".format(
-                    launcher), shell=True,
-                stderr=subprocess.STDOUT, check=True)
-            stop = time.time()
+            host = 'localhost'
+            if SLAVE_PORT is not None:
+                host += ':{}'.format(SLAVE_PORT)
+            elapsed = execute(
+                "{}; checkbox-cli master {} {}".format(
+                    activate(launcher), host, launcher), timeline, monitor,
+                env)
         except subprocess.CalledProcessError as exc:
-            print(exc.stdout.decode(sys.stdout.encoding))
+            if exc.output:
+                print(exc.output)
             raise SystemExit("Failed to remotely run launcher {}".format(
                 launcher))
         if slave_proc.poll() is not None:
             raise SystemExit("Slave died by its own. Benchmarking failed")
-    return stop - start
+        if monitor:
+            monitor.stop()
+            usage.append(monitor.report())
+    if allocations is not None:
+        allocations.append(collect_allocations(env))
+    if protocol is not None:
+        protocol.append(collect_protocol(env))
+    return elapsed
 
 
-def run_locally(launcher):
+def run_locally(launcher, timeline=None, usage=None, allocations=None):
     """Launch given launcher locally."""
+    env = tracing_env() if allocations is not None else None
+    monitor = None
+    if usage is not None:
+        monitor = ResourceMonitor()
+        monitor.start()
     try:
-        start = time.time()
-        subprocess.run(". venv/bin/activate; checkbox-cli {}".format(
-            launcher), shell=True, stderr=subprocess.STDOUT, check=True)
-        stop = time.time()
+        elapsed = execute("{}; checkbox-cli {}".format(
+            activate(launcher), launcher), timeline, monitor, env)
     except subprocess.CalledProcessError as exc:
-        print(exc.stdout.decode(sys.stdout.encoding))
+        if exc.output:
+            print(exc.output)
         raise SystemExit("Failed to remotely run launcher {}".format(launcher))
-    return stop - start
+    finally:
+        if monitor:
+            monitor.stop()
+    if monitor:
+        usage.append(monitor.report())
+    if env:
+        allocations.append(collect_allocations(env))
+    return elapsed
+
+
+def measure(run, launcher, repeat, warmup, timeline=None, usage=None,
+            allocations=None):
+    """Run `launcher` warmup + repeat times, return the measured times."""
+    for _ in range(warmup):
+        run(launcher)
+    return [run(launcher, timeline, usage, allocations)
+            for _ in range(repeat)]
+
+
+def summarize_allocations(allocations, top):
+    """Median peak and `top` allocation sites of every process over runs."""
+    summary = {}
+    for role in sorted({role for run in allocations for role in run}):
+        runs = [run[role] for run in allocations if role in run]
+        sites = {site for run in runs for site in run['sites']}
+        median_sizes = sorted((
+            (statistics.median(
+                run['sites'].get(site, (0, 0))[0] for run in runs), site)
+            for site in sites), reverse=True)
+        summary[role] = {
+            'peak_kb': statistics.median(run['peak'] for run in runs) / 1024,
+            'sites': {site: size / 1024
+                      for size, site in median_sizes[:ALLOCATION_SITES]},
+            'top': [site for _, site in median_sizes[:top]],
+        }
+    return summary
+
+
+def format_allocations(allocations):
+    """Render the peak and top allocation sites of every process."""
+    lines = []
+    for role, summary in sorted(allocations.items()):
+        lines.append("  {}: peak {:.0f} KiB".format(role, summary['peak_kb']))
+        for site in summary['top']:
+            lines.append("    {:>10.1f} KiB {}".format(
+                summary['sites'][site], site))
+    return '\n'.join(lines)
+
+
+def compare_allocations(before, after, top):
+    """Render how peak and allocation sites changed against a baseline."""
+    lines = []
+    for role in sorted(set(before) & set(after)):
+        old, new = before[role], after[role]
+        lines.append("  {}: peak {:.0f} KiB -> {:.0f} KiB".format(
+            role, old['peak_kb'], new['peak_kb']))
+        changes = sorted((
+            (new['sites'].get(site, 0) - old['sites'].get(site, 0), site)
+            for site in set(old['sites']) | set(new['sites'])),
+            key=lambda change: abs(change[0]), reverse=True)
+        for change, site in changes[:top]:
+            if change:
+                lines.append("    {:>+10.1f} KiB {}".format(change, site))
+    return '\n'.join(lines)
+
+
+def summarize_usage(usage):
+    """Median resource usage of every process over the measured runs."""
+    return {
+        name: {
+            metric: statistics.median(run[name][metric] for run in usage)
+            for metric in usage[0][name]}
+        for name in usage[0]}
+
+
+def summarize_phases(timeline):
+    """Median time of every phase over the measured runs."""
+    phases = [phase_breakdown(run['lines'], run['elapsed'])
+              for run in timeline]
+    return {
+        phase: statistics.median(run[phase] for run in phases)
+        for phase in PHASES}
+
+
+def protocol_breakdown(run, traffic):
+    """Remote protocol overhead of a run of master with a reused slave.
+
+    The connect latency and the round trips come from the traffic of master
+    itself, a round trip being the time from a request sent to the slave to
+    the first byte of the reply. The session setup is the time from
+    connecting to the first job in the debug log.
+    """
+    jobs = dict(PHASE_MARKERS)['jobs']
+    connected = None
+    first_job = None
+    for stamp, line in run['lines']:
+        if line.startswith('import time:'):
+            continue
+        if connected is None:
+            if RE_CONNECT.search(line):
+                connected = stamp
+        elif jobs.search(line):
+            first_job = stamp
+            break
+    round_trips = traffic['round_trips']
+    return {
+        'connect': traffic['connects'][0] if traffic['connects'] else None,
+        'session_setup': (
+            first_job - connected if first_job is not None else None),
+        'rpc_round_trip': (
+            statistics.median(round_trips) if round_trips else None),
+    }
+
+
+def summarize_protocol(timeline, traffic):
+    """Median remote protocol overhead over the runs."""
+    runs = [protocol_breakdown(run, run_traffic)
+            for run, run_traffic in zip(timeline, traffic)]
+    summary = {}
+    for metric in ['connect', 'session_setup', 'rpc_round_trip']:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        summary[metric] = statistics.median(values) if values else None
+    return summary
+
+
+def format_protocol(protocol):
+    """Render remote protocol overhead, skipping what wasn't found."""
+    return ', '.join(
+        '{} {:.3f}ms'.format(metric.replace('_', ' '), value * 1000)
+        for metric, value in sorted(protocol.items()) if value is not None)
+
+
+def format_phases(total, phases):
+    """Render phases as a stacked breakdown of the total time."""
+    return '{:.3f}s = {}'.format(total, ' + '.join(
+        '{} {:.3f}s ({:.0%})'.format(
+            phase, phases[phase], phases[phase] / total)
+        for phase in PHASES if phases[phase]))
+
+
+def percentile(samples, fraction):
+    """Linearly interpolated percentile of samples, fraction in [0, 1]."""
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (
+        position - lower)
+
+
+def bootstrap_ci(samples, statistic=statistics.median, confidence=0.95,
+                 resamples=2000):
+    """Bootstrap confidence interval of `statistic` over samples."""
+    rng = random.Random(0)
+    estimates = [
+        statistic([rng.choice(samples) for _ in samples])
+        for _ in range(resamples)]
+    alpha = (1 - confidence) / 2
+    return percentile(estimates, alpha), percentile(estimates, 1 - alpha)
+
+
+def summarize(samples, max_cv):
+    """Compute statistics of the measured times of one scenario."""
+    mean = statistics.mean(samples)
+    stdev = statistics.stdev(samples) if len(samples) > 1 else 0.0
+    ci_low, ci_high = bootstrap_ci(samples)
+    cv = stdev / mean if mean else 0.0
+    return {
+        'samples': samples,
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'p95': percentile(samples, 0.95),
+        'mean': mean,
+        'stdev': stdev,
+        'ci95': (ci_low, ci_high),
+        'cv': cv,
+        'noisy': len(samples) < 2 or cv > max_cv,
+    }
+
+
+RESULTS_FORMAT_VERSION = 1
+
+
+def checkbox_commit(checkbox_path):
+    """Return the commit of the checkbox-ng tree, marked if it's dirty."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=checkbox_path,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+        status = subprocess.check_output(
+            ['git', 'status', '--porcelain'], cwd=checkbox_path,
+            stderr=subprocess.DEVNULL, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + '-dirty' if status.strip() else commit
+
+
+def host_info():
+    """Describe the machine the benchmark runs on."""
+    info = {
+        'machine': platform.machine(),
+        'kernel': platform.release(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+    }
+    with contextlib.suppress(OSError):
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    info['cpu'] = line.split(':', 1)[1].strip()
+                    break
+    with contextlib.suppress(OSError):
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemTotal:'):
+                    info['memory'] = line.split(':', 1)[1].strip()
+                    break
+    info['fingerprint'] = hashlib.sha1(json.dumps(
+        info, sort_keys=True).encode()).hexdigest()[:12]
+    return info
+
+
+def save_results(path, results, commit, host):
+    """Write results as a versioned JSON document."""
+    with open(path, 'wt') as f:
+        json.dump({
+            'format_version': RESULTS_FORMAT_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'checkbox_commit': commit,
+            'host': host,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """Read results written by save_results."""
+    with open(path, 'rt') as f:
+        document = json.load(f)
+    if document.get('format_version') != RESULTS_FORMAT_VERSION:
+        raise SystemExit("{} has unsupported format version {}".format(
+            path, document.get('format_version')))
+    return document
+
+
+def permutation_test(baseline, current, permutations=10000):
+    """One-sided p-value of `current` having a higher median than `baseline`.
+
+    The samples are shuffled between the two groups and the p-value is the
+    fraction of shuffles whose difference of medians is at least as large as
+    the observed one.
+    """
+    observed = statistics.median(current) - statistics.median(baseline)
+    pooled = list(baseline) + list(current)
+    rng = random.Random(0)
+    extreme = 0
+    for _ in range(permutations):
+        rng.shuffle(pooled)
+        difference = (statistics.median(pooled[len(baseline):]) -
+                      statistics.median(pooled[:len(baseline)]))
+        if difference >= observed:
+            extreme += 1
+    return (extreme + 1) / (permutations + 1)
+
+
+def compare(baseline, results, threshold, alpha, top=10):
+    """Compare results with a baseline document, return regressed scenarios.
+
+    Allocations are compared too when both have them, without counting as
+    regressions.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline['results']:
+            print("{}: not in the baseline".format(name))
+            continue
+        before = baseline['results'][name]
+        after = results[name]
+        change = after['median'] / before['median'] - 1
+        p_value = permutation_test(before['samples'], after['samples'])
+        regressed = change > threshold and p_value < alpha
+        print("{}: {:.3f}s -> {:.3f}s ({:+.1%}, p={:.3f}){}".format(
+            name, before['median'], after['median'], change, p_value,
+            ' REGRESSION' if regressed else ''))
+        if 'allocations' in before and 'allocations' in after:
+            print(compare_allocations(
+                before['allocations'], after['allocations'], top))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def benchmark_scenario(scenario, launcher, args):
+    """Measure `launcher` locally and remotely, return results by name."""
+    if os.path.isdir(os.path.join(os.path.dirname(launcher), 'provider')):
+        develop_provider(os.path.dirname(launcher))
+    results = dict()
+    for mode, run in [('local', run_locally), ('remote', run_via_remote)]:
+        protocol = mode == 'remote' and args.reuse_slave
+        timeline = [] if args.phases else None
+        usage = [] if args.resources else None
+        allocations = [] if args.tracemalloc else None
+        result = summarize(measure(
+            run, launcher, args.repeat, args.warmup, timeline, usage,
+            allocations), args.max_cv)
+        if args.phases:
+            result['phases'] = summarize_phases(timeline)
+        if protocol:
+            # the debug log and the tracing of the traffic slow checkbox-cli
+            # down, so the protocol overhead is taken from runs of its own
+            protocol_timeline = []
+            traffic = []
+            for _ in range(args.repeat):
+                run_via_remote(
+                    launcher, protocol_timeline, protocol=traffic)
+            result['protocol'] = summarize_protocol(
+                protocol_timeline, traffic)
+        if usage:
+            result['resources'] = summarize_usage(usage)
+        if allocations:
+            result['allocations'] = summarize_allocations(
+                allocations, args.tracemalloc_top)
+        results['{}-{}'.format(mode, scenario)] = result
+    return results
+
+
+def synthetic_scenarios(args, workdir):
+    """Generate the synthetic providers to sweep, return their parameters."""
+    scenarios = []
+    for jobs, test_plans, fanout, depth in itertools.product(
+            args.synthetic, args.synthetic_test_plans,
+            args.synthetic_fanout, args.synthetic_depth):
+        name = 'synthetic-{}j-{}p-{}f-{}d'.format(
+            jobs, test_plans, fanout, depth)
+        path = os.path.join(workdir, 'synthetic', name)
+        shutil.rmtree(path, ignore_errors=True)
+        generate_provider(path, jobs, test_plans, fanout, depth)
+        scenarios.append((name, jobs, (test_plans, fanout, depth)))
+    return scenarios
+
+
+def growth_exponent(points):
+    """Least-squares exponent k of time ~ size^k over (size, time) points."""
+    xs = [math.log(size) for size, _ in points]
+    ys = [math.log(elapsed) for _, elapsed in points]
+    mean_x = statistics.mean(xs)
+    mean_y = statistics.mean(ys)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) /
+            sum((x - mean_x) ** 2 for x in xs))
+
+
+def print_scaling(results, scenarios):
+    """Print medians of the synthetic scenarios against the number of jobs."""
+    by_shape = dict()
+    for name, jobs, shape in scenarios:
+        by_shape.setdefault(shape, []).append((jobs, name))
+    for (test_plans, fanout, depth), points in sorted(by_shape.items()):
+        points.sort()
+        print("test plans {}, fan-out {}, depth {}:".format(
+            test_plans, fanout, depth))
+        print("{:>10} {:>10} {:>10}".format('jobs', 'local', 'remote'))
+        for jobs, name in points:
+            print("{:>10} {:>9.3f}s {:>9.3f}s".format(
+                jobs, results['local-' + name]['median'],
+                results['remote-' + name]['median']))
+        if len({jobs for jobs, _ in points}) > 1:
+            for mode in ['local', 'remote']:
+                print("{} time ~ jobs^{:.2f}".format(mode, growth_exponent([
+                    (jobs, results['{}-{}'.format(mode, name)]['median'])
+                    for jobs, name in points])))
+
+
+def cpu_sets(count):
+    """Split the CPUs we may run on into `count` disjoint sets.
+
+    Return None if there are fewer CPUs than sets.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < count:
+        return None
+    size = len(cpus) // count
+    return [cpus[i * size:(i + 1) * size] for i in range(count)]
+
+
+def init_worker(workers, workdir, reuse_slave):
+    """Set up an isolated working directory for a parallel worker process."""
+    global SLAVE_PORT
+    index, cpus = workers.get()
+    path = os.path.join(workdir, 'worker-{}'.format(index))
+    os.makedirs(path, exist_ok=True)
+    # the venv is built once, as mk-venv writes into the checkbox-ng tree
+    # and concurrent builds would race in there
+    for name in ['checkbox-ng', 'benchmarking-provider', 'venv']:
+        link = os.path.join(path, name)
+        if os.path.isdir(link) and not os.path.islink(link):
+            shutil.rmtree(link)
+        if not os.path.lexists(link):
+            os.symlink(os.path.join(workdir, name), link)
+    os.chdir(path)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    # keep the sessions of concurrent runs apart
+    os.environ['XDG_CACHE_HOME'] = os.path.join(path, 'cache')
+    SLAVE_PORT = FIRST_WORKER_PORT + index
+    if reuse_slave:
+        # workers don't run atexit handlers, but they do run finalizers
+        multiprocessing.util.Finalize(
+            None, stop_slave, args=(start_reused_slave(),), exitpriority=10)
+
+
+def benchmark_in_parallel(scenarios, launchers, args, workdir):
+    """Benchmark scenarios in up to args.parallel worker processes."""
+    count = min(args.parallel, len(scenarios))
+    sets = cpu_sets(count)
+    if sets is None:
+        print("WARNING: fewer CPUs than workers, concurrent scenarios will "
+              "disturb each other's timings")
+    workers = multiprocessing.Queue()
+    for index in range(count):
+        workers.put((index, sets[index] if sets else None))
+    results = dict()
+    with concurrent.futures.ProcessPoolExecutor(
+            count, initializer=init_worker,
+            initargs=(workers, workdir, args.reuse_slave)) as executor:
+        futures = [
+            executor.submit(benchmark_scenario, scenario, launcher, args)
+            for scenario, launcher in zip(scenarios, launchers)]
+        try:
+            for future in futures:
+                results.update(future.result())
+        except concurrent.futures.process.BrokenProcessPool:
+            raise SystemExit("Failed to prepare a worker")
+    return results
 
 
 def main():
@@ -101,33 +1324,176 @@ def main():
         'checkbox_path', help='Path to where Checkbox can be found')
     parser.add_argument(
         '--provider-repository',
-        help='Location of the benchmarking provider repository',
+        help=('Location of the benchmarking provider repository, or a '
+              'directory with the provider'),
         default=(
             'https://git.launchpad.net/~checkbox-dev/'
             'checkbox/+git/benchmarking-provider'))
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='How many measured runs of every scenario to do (default: 5)')
+    parser.add_argument(
+        '--warmup', type=int, default=1,
+        help='How many unmeasured runs to do before measuring (default: 1)')
+    parser.add_argument(
+        '--max-cv', type=float, default=0.1,
+        help=('Coefficient of variation above which a scenario is flagged '
+              'as too noisy (default: 0.1)'))
+    parser.add_argument(
+        '--output', help='Save the results to this JSON file')
+    parser.add_argument(
+        '--compare', metavar='BASELINE.json',
+        help='Compare the results with the ones saved by --output')
+    parser.add_argument(
+        '--threshold', type=float, default=0.05,
+        help=('Relative slowdown of the median above which a scenario is '
+              'considered a regression (default: 0.05)'))
+    parser.add_argument(
+        '--alpha', type=float, default=0.05,
+        help=('Significance level of the test for regressions '
+              '(default: 0.05)'))
+    parser.add_argument(
+        '--phases', action='store_true',
+        help='Break every scenario down into phases')
+    parser.add_argument(
+        '--resources', action='store_true',
+        help=('Record CPU, memory, context switch, block I/O and file '
+              'descriptor usage of every scenario'))
+    parser.add_argument(
+        '--parallel', type=int, default=1, metavar='N',
+        help='Benchmark up to N scenarios at the same time (default: 1)')
+    parser.add_argument(
+        '--cache-dir', default=default_cache_dir(),
+        help='Where to cache the benchmark environments')
+    parser.add_argument(
+        '--cache-size', type=int, default=3,
+        help='How many cached environments to keep (default: 3)')
+    parser.add_argument(
+        '--offline', action='store_true',
+        help="Don't update the mirror of the provider repository")
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Set up the environment from scratch in a temporary directory')
+    parser.add_argument(
+        '--reuse-slave', action='store_true',
+        help=('Run all remote scenarios on one slave and measure the remote '
+              'protocol overhead'))
+    parser.add_argument(
+        '--tracemalloc', action='store_true',
+        help='Trace memory allocations of checkbox-cli')
+    parser.add_argument(
+        '--tracemalloc-top', type=int, default=10, metavar='N',
+        help='How many allocation sites to report (default: 10)')
+    parser.add_argument(
+        '--synthetic', type=size_list, metavar='JOBS[,JOBS...]',
+        help='Benchmark synthetic providers with these numbers of jobs')
+    parser.add_argument(
+        '--synthetic-test-plans', type=size_list, default=[1],
+        metavar='N[,N...]',
+        help='Numbers of test plans of the synthetic providers (default: 1)')
+    parser.add_argument(
+        '--synthetic-fanout', type=size_list, default=[10],
+        metavar='N[,N...]',
+        help=('Numbers of jobs requiring the same resource job in the '
+              'synthetic providers (default: 10)'))
+    parser.add_argument(
+        '--synthetic-depth', type=size_list, default=[1],
+        metavar='N[,N...]',
+        help=('Lengths of the dependency chains in the synthetic providers '
+              '(default: 1)'))
     args = parser.parse_args()
-    with tempfile.TemporaryDirectory(prefix='cbox-bench') as tmpdir:
-        os.chdir(tmpdir)
-        shutil.copytree(
-            args.checkbox_path, 'checkbox-ng')
-        subprocess.run(
-            ['git', 'clone', args.provider_repository,
-             'benchmarking-provider'], check=True)
-        launchers = glob.glob('benchmarking-provider/launcher-*')
-        scenarios = [s.replace(
-            'benchmarking-provider/launcher-', '') for s in launchers]
-        results = dict()
-        prepare_venv(os.path.join(tmpdir, 'venv'))
-        for scenario in scenarios:
-            local_result = run_locally(os.path.join(
-                tmpdir, 'benchmarking-provider',
-                'launcher-{}'.format(scenario)))
-            remote_result = run_via_remote(os.path.join(
-                tmpdir, 'benchmarking-provider',
-                'launcher-{}'.format(scenario)))
-            results['local-{}'.format(scenario)] = local_result
-            results['remote-{}'.format(scenario)] = remote_result
+    if args.repeat < 1 or args.warmup < 0:
+        raise SystemExit("--repeat must be positive and --warmup not negative")
+    if args.parallel < 1:
+        raise SystemExit("--parallel must be positive")
+    if args.cache_size < 1:
+        raise SystemExit("--cache-size must be positive")
+    if args.synthetic and args.reuse_slave:
+        # the slave would have to see the providers of every scenario
+        raise SystemExit("--synthetic can't be used with --reuse-slave")
+    if args.tracemalloc and args.reuse_slave:
+        # the slave only dumps its allocations when it exits, which a reused
+        # one doesn't do between the runs
+        raise SystemExit("--tracemalloc can't be used with --reuse-slave")
+    # the paths have to survive changing directory to the temporary one
+    args.checkbox_path = os.path.abspath(args.checkbox_path)
+    args.cache_dir = os.path.abspath(args.cache_dir)
+    if os.path.exists(args.provider_repository):
+        args.provider_repository = os.path.abspath(args.provider_repository)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    baseline = load_results(args.compare) if args.compare else None
+    commit = checkbox_commit(args.checkbox_path)
+    host = host_info()
+    with contextlib.ExitStack() as stack:
+        if args.no_cache:
+            workdir = stack.enter_context(
+                tempfile.TemporaryDirectory(prefix='cbox-bench'))
+            shutil.copytree(
+                args.checkbox_path, os.path.join(workdir, 'checkbox-ng'))
+        else:
+            workdir = stack.enter_context(cached_workdir(
+                args.cache_dir, args.checkbox_path, args.cache_size))
+        os.chdir(workdir)
+        source = args.provider_repository
+        if not os.path.exists(source):
+            source = update_mirror(
+                source, os.path.join(args.cache_dir, MIRRORS_DIR),
+                args.offline)
+        provider_commit = fetch_provider(source, 'benchmarking-provider')
+        print("Benchmarking provider {}".format(provider_commit))
+        if args.synthetic:
+            synthetic = synthetic_scenarios(args, workdir)
+            scenarios = [name for name, _, _ in synthetic]
+            launchers = [
+                os.path.join(workdir, 'synthetic', name, 'launcher')
+                for name in scenarios]
+        else:
+            launchers = glob.glob('benchmarking-provider/launcher-*')
+            scenarios = [s.replace(
+                'benchmarking-provider/launcher-', '') for s in launchers]
+            launchers = [
+                os.path.join(workdir, launcher) for launcher in launchers]
+        ensure_venv(os.path.join(workdir, 'venv'))
+        if args.parallel > 1:
+            results = benchmark_in_parallel(
+                scenarios, launchers, args, workdir)
+        else:
+            results = dict()
+            if args.reuse_slave:
+                stack.callback(stop_slave, start_reused_slave())
+            for scenario, launcher in zip(scenarios, launchers):
+                results.update(benchmark_scenario(scenario, launcher, args))
         pprint(results)
+        for name, result in sorted(results.items()):
+            if 'phases' in result:
+                print("{}: {}".format(name, format_phases(
+                    result['median'], result['phases'])))
+            if 'protocol' in result:
+                print("{}: {}".format(
+                    name, format_protocol(result['protocol'])))
+            if 'allocations' in result:
+                print("{}:\n{}".format(
+                    name, format_allocations(result['allocations'])))
+        if args.synthetic:
+            print_scaling(results, synthetic)
+        for name, result in sorted(results.items()):
+            if result['noisy']:
+                print("WARNING: {} is too noisy to be trusted (cv={:.1%})"
+                      .format(name, result['cv']))
+    if args.output:
+        save_results(args.output, results, commit, host)
+    if baseline:
+        if baseline['host']['fingerprint'] != host['fingerprint']:
+            print("WARNING: the baseline was measured on a different host")
+        print("Comparing with checkbox-ng {}".format(
+            baseline['checkbox_commit']))
+        regressions = compare(
+            baseline, results, args.threshold, args.alpha,
+            args.tracemalloc_top)
+        if regressions:
+            raise SystemExit("{} scenario(s) regressed: {}".format(
+                len(regressions), ', '.join(regressions)))
 
 
 if __name__ == '__main__':
@@ -76,20 +76,29 @@ same line, but it is far from perfect (in either direction).
 """
 
 import codecs
+import collections
 import copy
 import getopt
+import hashlib
+import json
 import math  # for log
+import multiprocessing
 import os
 import re
 import sre_compile
 import string
+import subprocess
 import sys
+import tempfile
+import time
 import unicodedata
 
 
 _USAGE = """
-Syntax: cpplint.py [--verbose=#] [--output=vs7] [--filter=-x,+y,...]
-                   [--counting=total|toplevel|detailed]
+Syntax: cpplint.py [--verbose=#] [--output=vs7|eclipse|jsonl|sarif]
+                   [--filter=-x,+y,...]
+                   [--counting=total|toplevel|detailed] [--jobs=#]
+                   [--no-cache] [--diff-base=rev] [--profile=file.json]
         <file> [file] ...
 
   The style guidelines this tries to follow are those in
@@ -108,9 +117,15 @@ Syntax: cpplint.py [--verbose=#] [--output=vs7] [--filter=-x,+y,...]
 
   Flags:
 
-    output=vs7
+    output=vs7|eclipse|jsonl|sarif
       By default, the output is formatted to ease emacs parsing.  Visual Studio
-      compatible output (vs7) may also be used.  Other formats are unsupported.
+      compatible output (vs7) and Eclipse compatible output (eclipse) may also
+      be used.  These are written to stderr.
+
+      For tools, errors can instead be written to stdout as JSON: jsonl writes
+      one JSON object per error and per line, sarif writes a single SARIF
+      2.1.0 log once all the files are processed.  Progress messages and error
+      counts are still written to stderr.
 
     verbose=#
       Specify a number 0-5 to restrict errors to certain verbosity levels.
@@ -152,6 +167,37 @@ Syntax: cpplint.py [--verbose=#] [--output=vs7] [--filter=-x,+y,...]
         No flag => CHROME_BROWSER_UI_BROWSER_H_
         --root=chrome => BROWSER_UI_BROWSER_H_
         --root=chrome/browser => UI_BROWSER_H_
+
+    jobs=#
+      Lint up to # files at the same time, each one in a separate worker
+      process.  The output and the exit code are the same as the ones of a
+      serial run, only faster on multi-core machines.  Reading from stdin
+      ("-") always falls back to a serial run.  Defaults to 1.
+
+    no-cache
+      By default, the errors found in a file are remembered in a cache
+      directory ($XDG_CACHE_HOME/cpplint or ~/.cache/cpplint), keyed by the
+      contents of the file, its path, the root of its repository, the
+      filters, the verbosity, the root and the version of cpplint.  Files
+      that did not change since the last run are not linted again, their
+      errors are replayed from the cache instead.  This flag disables the
+      cache.
+
+    diff-base=rev
+      Only report errors on the lines changed since the given git revision,
+      as shown by "git diff rev -- <file>".  Whole files are still parsed to
+      track the nesting of blocks and the includes, but the per-line checks
+      only run on the changed lines, so the time spent on a file depends on
+      the size of the change.  Files that git does not track are linted as a
+      whole.  The cache is not used in this mode.
+
+    profile=file.json
+      Measure the wall time and the number of calls of every check, the time
+      spent on every file, and the size and hit rate of the regular
+      expression cache.  A summary table is written to stderr at the end of
+      the run, and all the numbers are dumped to the given JSON file.  Time
+      of a check includes the time of the checks it calls.  Use --no-cache
+      to profile files that did not change since the last run.
 """
 
 # We categorize each error message we print.  Here are the categories.
@@ -357,6 +403,41 @@ _error_suppressions = {}
 # This is set by --root flag.
 _root = None
 
+# The number of worker processes used to lint files in parallel.
+# This is set by --jobs flag.
+_jobs = 1
+
+# The directory in which lint results are cached, or None if caching is
+# disabled.  This is cleared by --no-cache flag.
+_cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'cpplint')
+
+# Least recently used cache entries are removed once the cache directory
+# grows beyond this many bytes.
+_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# The git revision against which changed lines are computed, or None to lint
+# all lines.  This is set by --diff-base flag.
+_diff_base = None
+
+# Matches the header of a hunk in unified diff output, capturing the
+# first line and the number of lines of the hunk in the new file.
+_RE_PATTERN_DIFF_HUNK = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@',
+                                   re.MULTILINE)
+
+# The name of the JSON file to which profiling results are written, or None
+# if cpplint is not profiled.  This is set by --profile flag.
+_profile_path = None
+
+# The _Profiler measuring this run, if any.
+_profiler = None
+
+# The list of headers opened by UpdateIncludeState while the current file
+# is being linted, or None if nobody is interested in them.  Results of a
+# file depend on these headers, so they are part of its cache entry.
+_include_dependencies = None
+
 def ParseNolintSuppressions(filename, raw_line, linenum, error):
   """Updates the global list of error-suppressions.
 
@@ -548,6 +629,117 @@ class _IncludeState(dict):
     return ''
 
 
+class ErrorSink(object):
+  """Receives the errors that pass the filters, and outputs them.
+
+  Errors are passed to Write one by one, in the order in which they are
+  found.  Flush is called once all the files are processed.
+  """
+
+  def Write(self, filename, linenum, category, confidence, message):
+    """Outputs one error; see Error for the meaning of the arguments."""
+    pass
+
+  def Flush(self):
+    """Outputs whatever is still buffered."""
+    pass
+
+
+class TextErrorSink(ErrorSink):
+  """Writes errors to stderr, formatted for emacs, vs7 or eclipse."""
+
+  _FORMATS = {
+      'emacs': '%s:%s:  %s  [%s] [%d]\n',
+      'vs7': '%s(%s):  %s  [%s] [%d]\n',
+      'eclipse': '%s:%s: warning: %s  [%s] [%d]\n',
+      }
+
+  def __init__(self, output_format='emacs'):
+    self._format = self._FORMATS[output_format]
+
+  def Write(self, filename, linenum, category, confidence, message):
+    # Errors are interleaved with progress messages on stderr, so they are
+    # not buffered.
+    sys.stderr.write(self._format % (
+        filename, linenum, message, category, confidence))
+
+
+class JsonLinesErrorSink(ErrorSink):
+  """Writes errors to stdout as JSON objects, one per line.
+
+  Lines are buffered and written in batches, so a full run makes a handful
+  of writes instead of one per error.
+  """
+
+  _BATCH_SIZE = 1024
+
+  def __init__(self):
+    self._lines = []
+
+  def Write(self, filename, linenum, category, confidence, message):
+    self._lines.append(json.dumps({
+        'file': filename, 'line': linenum, 'category': category,
+        'confidence': confidence, 'message': message}, sort_keys=True) + '\n')
+    if len(self._lines) >= self._BATCH_SIZE:
+      self.Flush()
+
+  def Flush(self):
+    if self._lines:
+      sys.stdout.write(''.join(self._lines))
+      sys.stdout.flush()
+      self._lines = []
+
+
+class SarifErrorSink(ErrorSink):
+  """Writes all the errors to stdout as a single SARIF 2.1.0 log."""
+
+  def __init__(self):
+    self._results = []
+    self._rule_ids = set()
+
+  def Write(self, filename, linenum, category, confidence, message):
+    location = {'artifactLocation': {'uri': filename}}
+    # Errors that apply to a whole file are reported on line 0.
+    if linenum > 0:
+      location['region'] = {'startLine': linenum}
+    self._results.append({
+        'ruleId': category,
+        'level': 'warning',
+        'message': {'text': message},
+        'locations': [{'physicalLocation': location}],
+        'properties': {'confidence': confidence},
+        })
+    self._rule_ids.add(category)
+
+  def Flush(self):
+    sys.stdout.write(json.dumps({
+        'version': '2.1.0',
+        '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+        'runs': [{
+            'tool': {'driver': {
+                'name': 'cpplint',
+                'informationUri': ('http://google-styleguide.googlecode.com'
+                                   '/svn/trunk/cppguide.xml'),
+                'rules': [{'id': rule_id}
+                          for rule_id in sorted(self._rule_ids)],
+                }},
+            'results': self._results,
+            }],
+        }, sort_keys=True) + '\n')
+    sys.stdout.flush()
+    self._results = []
+    self._rule_ids = set()
+
+
+def _MakeErrorSink(output_format):
+  """Returns a new ErrorSink for the given --output value."""
+  if output_format == 'jsonl':
+    return JsonLinesErrorSink()
+  elif output_format == 'sarif':
+    return SarifErrorSink()
+  return TextErrorSink(output_format)
+
+
 class _CppLintState(object):
   """Maintains module-wide state.."""
 
@@ -556,17 +748,32 @@ class _CppLintState(object):
     self.error_count = 0    # global count of reported errors
     # filters to apply when emitting error messages
     self.filters = _DEFAULT_FILTERS[:]
+    # memoized verdicts of the filters, see IsCategoryFiltered
+    self._filter_verdicts = {}
+    self._all_filtered_verdicts = {}
     self.counting = 'total'  # In what way are we counting errors?
     self.errors_by_category = {}  # string to int dict storing error counts
 
     # output format:
     # "emacs" - format that emacs can parse (default)
     # "vs7" - format that Microsoft Visual Studio 7 can parse
+    # "eclipse" - format that Eclipse can parse
+    # "jsonl" - one JSON object per line
+    # "sarif" - a SARIF log
     self.output_format = 'emacs'
+    # the ErrorSink that outputs errors in the above format
+    self.error_sink = TextErrorSink()
 
   def SetOutputFormat(self, output_format):
     """Sets the output format for errors."""
     self.output_format = output_format
+    self.error_sink = _MakeErrorSink(output_format)
+
+  def SetErrorSink(self, error_sink):
+    """Sets the ErrorSink that outputs errors, and returns the previous one."""
+    last_error_sink = self.error_sink
+    self.error_sink = error_sink
+    return last_error_sink
 
   def SetVerboseLevel(self, level):
     """Sets the module's verbosity, and returns the previous setting."""
@@ -593,15 +800,72 @@ class _CppLintState(object):
                   E.g. "-,+whitespace,-whitespace/indent,whitespace/badfilter"
     """
     # Default filters always have less priority than the flag ones.
-    self.filters = _DEFAULT_FILTERS[:]
+    filter_list = _DEFAULT_FILTERS[:]
     for filt in filters.split(','):
       clean_filt = filt.strip()
       if clean_filt:
-        self.filters.append(clean_filt)
-    for filt in self.filters:
+        filter_list.append(clean_filt)
+    for filt in filter_list:
       if not (filt.startswith('+') or filt.startswith('-')):
         raise ValueError('Every filter in --filters must start with + or -'
                          ' (%s does not)' % filt)
+    self.SetFilterList(filter_list)
+
+  def SetFilterList(self, filters):
+    """Sets the error-message filters from an already validated list.
+
+    Args:
+      filters: A list of filters, default ones included, each starting with
+               + or -.
+    """
+    self.filters = filters[:]
+    self._filter_verdicts = {}
+    self._all_filtered_verdicts = {}
+
+  def IsCategoryFiltered(self, category):
+    """Returns whether the filters reject the given error category.
+
+    The filters are evaluated once per category; the verdict is memoized
+    until the filters change.
+
+    Args:
+      category: str, the category of an error.
+    Returns:
+      bool, True iff errors of this category should not be printed.
+    """
+    try:
+      return self._filter_verdicts[category]
+    except KeyError:
+      pass
+    is_filtered = False
+    for one_filter in self.filters:
+      if one_filter.startswith('-'):
+        if category.startswith(one_filter[1:]):
+          is_filtered = True
+      elif one_filter.startswith('+'):
+        if category.startswith(one_filter[1:]):
+          is_filtered = False
+      else:
+        assert False  # should have been checked for in SetFilter.
+    self._filter_verdicts[category] = is_filtered
+    return is_filtered
+
+  def AreAllCategoriesFiltered(self, categories):
+    """Returns whether the filters reject every one of the given categories.
+
+    Args:
+      categories: tuple of str, the categories of errors.
+    Returns:
+      bool, True iff no error of these categories should be printed.
+    """
+    try:
+      return self._all_filtered_verdicts[categories]
+    except KeyError:
+      pass
+    all_filtered = all(self.IsCategoryFiltered(category)
+                       for category in categories)
+    self._all_filtered_verdicts[categories] = all_filtered
+    return all_filtered
 
   def ResetErrorCounts(self):
     """Sets the module's error statistic back to zero."""
@@ -732,6 +996,74 @@ class _IncludeError(Exception):
   pass
 
 
+# {str, str}: maps from directories to the roots of the checkouts they are
+# in, or to None for directories outside of any checkout.  They are shared
+# by all the files linted in a run, so that the directory tree is only
+# walked once.  _repository_roots holds the answers of _FindRepositoryRoot,
+# _top_level_dirs the ones of _FindTopLevelDir.
+_repository_roots = {}
+_top_level_dirs = {}
+
+
+def _FindTopLevelDir(directory):
+  """Finds the closest directory with .git, .hg or .svn, going up the tree.
+
+  Args:
+    directory: An absolute directory name.
+
+  Returns:
+    directory or its closest parent containing .git, .hg or .svn, or None if
+    there is none.
+  """
+  # Every directory on the way has no .git, .hg or .svn, so it shares the
+  # answer with the starting directory.
+  visited_dirs = []
+  root_dir = directory
+  while (root_dir not in _top_level_dirs and
+         root_dir != os.path.dirname(root_dir) and
+         not os.path.exists(os.path.join(root_dir, ".git")) and
+         not os.path.exists(os.path.join(root_dir, ".hg")) and
+         not os.path.exists(os.path.join(root_dir, ".svn"))):
+    visited_dirs.append(root_dir)
+    root_dir = os.path.dirname(root_dir)
+
+  if root_dir in _top_level_dirs:
+    root_dir = _top_level_dirs[root_dir]
+  elif not (os.path.exists(os.path.join(root_dir, ".git")) or
+            os.path.exists(os.path.join(root_dir, ".hg")) or
+            os.path.exists(os.path.join(root_dir, ".svn"))):
+    root_dir = None
+  for visited_dir in visited_dirs:
+    _top_level_dirs[visited_dir] = root_dir
+  return root_dir
+
+
+def _FindRepositoryRoot(project_dir):
+  """Finds the top directory of the checkout that contains a directory.
+
+  Args:
+    project_dir: An absolute directory name.
+
+  Returns:
+    The root directory of the checkout, or None if there is none.
+  """
+  if project_dir not in _repository_roots:
+    if os.path.exists(os.path.join(project_dir, ".svn")):
+      # If there's a .svn file in the current directory, we recursively look
+      # up the directory tree for the top of the SVN checkout
+      root_dir = project_dir
+      one_up_dir = os.path.dirname(root_dir)
+      while os.path.exists(os.path.join(one_up_dir, ".svn")):
+        root_dir = os.path.dirname(root_dir)
+        one_up_dir = os.path.dirname(one_up_dir)
+    else:
+      # Not SVN <= 1.6? Try to find a git, hg, or svn top level directory by
+      # searching up from the current path.
+      root_dir = _FindTopLevelDir(project_dir)
+    _repository_roots[project_dir] = root_dir
+  return _repository_roots[project_dir]
+
+
 class FileInfo:
   """Provides utility functions for filenames.
 
@@ -741,6 +1073,7 @@ class FileInfo:
 
   def __init__(self, filename):
     self._filename = filename
+    self._split = None
 
   def FullName(self):
     """Make Windows paths like Unix."""
@@ -760,31 +1093,8 @@ class FileInfo:
 
     if os.path.exists(fullname):
       project_dir = os.path.dirname(fullname)
-
-      if os.path.exists(os.path.join(project_dir, ".svn")):
-        # If there's a .svn file in the current directory, we recursively look
-        # up the directory tree for the top of the SVN checkout
-        root_dir = project_dir
-        one_up_dir = os.path.dirname(root_dir)
-        while os.path.exists(os.path.join(one_up_dir, ".svn")):
-          root_dir = os.path.dirname(root_dir)
-          one_up_dir = os.path.dirname(one_up_dir)
-
-        prefix = os.path.commonprefix([root_dir, project_dir])
-        return fullname[len(prefix) + 1:]
-
-      # Not SVN <= 1.6? Try to find a git, hg, or svn top level directory by
-      # searching up from the current path.
-      root_dir = os.path.dirname(fullname)
-      while (root_dir != os.path.dirname(root_dir) and
-             not os.path.exists(os.path.join(root_dir, ".git")) and
-             not os.path.exists(os.path.join(root_dir, ".hg")) and
-             not os.path.exists(os.path.join(root_dir, ".svn"))):
-        root_dir = os.path.dirname(root_dir)
-
-      if (os.path.exists(os.path.join(root_dir, ".git")) or
-          os.path.exists(os.path.join(root_dir, ".hg")) or
-          os.path.exists(os.path.join(root_dir, ".svn"))):
+      root_dir = _FindRepositoryRoot(project_dir)
+      if root_dir is not None:
         prefix = os.path.commonprefix([root_dir, project_dir])
         return fullname[len(prefix) + 1:]
 
@@ -801,9 +1111,11 @@ class FileInfo:
       A tuple of (directory, basename, extension).
     """
 
-    googlename = self.RepositoryName()
-    project, rest = os.path.split(googlename)
-    return (project,) + os.path.splitext(rest)
+    if self._split is None:
+      googlename = self.RepositoryName()
+      project, rest = os.path.split(googlename)
+      self._split = (project,) + os.path.splitext(rest)
+    return self._split
 
   def BaseName(self):
     """File base name - text after the final slash, before the final period."""
@@ -832,18 +1144,7 @@ def _ShouldPrintError(category, confidence, linenum):
     return False
   if confidence < _cpplint_state.verbose_level:
     return False
-
-  is_filtered = False
-  for one_filter in _Filters():
-    if one_filter.startswith('-'):
-      if category.startswith(one_filter[1:]):
-        is_filtered = True
-    elif one_filter.startswith('+'):
-      if category.startswith(one_filter[1:]):
-        is_filtered = False
-    else:
-      assert False  # should have been checked for in SetFilter.
-  if is_filtered:
+  if _cpplint_state.IsCategoryFiltered(category):
     return False
 
   return True
@@ -872,16 +1173,14 @@ def Error(filename, linenum, category, confidence, message):
     message: The error message.
   """
   if _ShouldPrintError(category, confidence, linenum):
-    _cpplint_state.IncrementErrorCount(category)
-    if _cpplint_state.output_format == 'vs7':
-      sys.stderr.write('%s(%s):  %s  [%s] [%d]\n' % (
-          filename, linenum, message, category, confidence))
-    elif _cpplint_state.output_format == 'eclipse':
-      sys.stderr.write('%s:%s: warning: %s  [%s] [%d]\n' % (
-          filename, linenum, message, category, confidence))
-    else:
-      sys.stderr.write('%s:%s:  %s  [%s] [%d]\n' % (
-          filename, linenum, message, category, confidence))
+    _PrintError(filename, linenum, category, confidence, message)
+
+
+def _PrintError(filename, linenum, category, confidence, message):
+  """Counts and prints an error that is known to pass all the filters."""
+  _cpplint_state.IncrementErrorCount(category)
+  _cpplint_state.error_sink.Write(filename, linenum, category, confidence,
+                                  message)
 
 
 # Matches standard C++ escape esequences per 2.13.2.3 of the C++ standard.
@@ -990,22 +1289,47 @@ class CleansedLines(object):
   2) lines member contains lines without comments, and
   3) raw_lines member contains all the lines without processing.
   All these three members are of <type 'list'>, and of the same length.
+  raw_lines is the list passed to the constructor, the other two are built
+  as whole lists the first time they are read.  Lines that are not changed
+  by the preprocessing share the string object of the less processed copy.
   """
 
   def __init__(self, lines):
-    self.elided = []
-    self.lines = []
     self.raw_lines = lines
     self.num_lines = len(lines)
-    for linenum in range(len(lines)):
-      self.lines.append(CleanseComments(lines[linenum]))
-      elided = self._CollapseStrings(lines[linenum])
-      self.elided.append(CleanseComments(elided))
+
+  def __getattr__(self, name):
+    # Only called while the attribute is not set yet, so once a copy is
+    # computed, it is accessed as fast as a regular attribute.
+    if name == 'lines':
+      value = [self._CleanseLine(raw_line) for raw_line in self.raw_lines]
+    elif name == 'elided':
+      value = [self._ElideLine(linenum) for linenum in range(self.num_lines)]
+    else:
+      raise AttributeError(name)
+    setattr(self, name, value)
+    return value
 
   def NumLines(self):
     """Returns the number of lines represented."""
     return self.num_lines
 
+  @staticmethod
+  def _CleanseLine(raw_line):
+    """Computes the line without comments."""
+    line = CleanseComments(raw_line)
+    if line == raw_line:
+      return raw_line
+    return line
+
+  def _ElideLine(self, linenum):
+    """Computes the line without strings and comments."""
+    raw_line = self.raw_lines[linenum]
+    collapsed = self._CollapseStrings(raw_line)
+    if collapsed == raw_line:
+      return self.lines[linenum]
+    return CleanseComments(collapsed)
+
   @staticmethod
   def _CollapseStrings(elided):
     """Collapses strings and chars on a line to simple "" or '' blocks.
@@ -1357,10 +1681,15 @@ def CheckInvalidIncrement(filename, clean_lines, linenum, error):
 class _BlockInfo(object):
   """Stores information about a generic block of code."""
 
+  __slots__ = ('seen_open_brace', 'open_parentheses', 'inline_asm', 'frozen')
+
   def __init__(self, seen_open_brace):
     self.seen_open_brace = seen_open_brace
     self.open_parentheses = 0
     self.inline_asm = _NO_ASM
+    # Whether this object is part of a saved preprocessor stack and thus
+    # must be copied before it is modified.  See _NestingState.
+    self.frozen = False
 
   def CheckBegin(self, filename, clean_lines, linenum, error):
     """Run checks that applies to text up to the opening brace.
@@ -1394,6 +1723,8 @@ class _BlockInfo(object):
 class _ClassInfo(_BlockInfo):
   """Stores information about a class."""
 
+  __slots__ = ('name', 'starting_linenum', 'is_derived', 'access', 'last_line')
+
   def __init__(self, name, class_or_struct, clean_lines, linenum):
     _BlockInfo.__init__(self, False)
     self.name = name
@@ -1427,6 +1758,8 @@ class _ClassInfo(_BlockInfo):
 class _NamespaceInfo(_BlockInfo):
   """Stores information about a namespace."""
 
+  __slots__ = ('name', 'starting_linenum')
+
   def __init__(self, name, linenum):
     _BlockInfo.__init__(self, False)
     self.name = name or ''
@@ -1481,12 +1814,14 @@ class _NamespaceInfo(_BlockInfo):
 class _PreprocessorInfo(object):
   """Stores checkpoints of nesting stacks when #if/#else is seen."""
 
+  __slots__ = ('stack_before_if', 'stack_before_else', 'seen_else')
+
   def __init__(self, stack_before_if):
     # The entire nesting stack before #if
     self.stack_before_if = stack_before_if
 
     # The entire nesting stack up to #else
-    self.stack_before_else = []
+    self.stack_before_else = ()
 
     # Whether we have already seen #else or #elif
     self.seen_else = False
@@ -1507,6 +1842,34 @@ class _NestingState(object):
     # Stack of _PreprocessorInfo objects.
     self.pp_stack = []
 
+  def _SaveStack(self):
+    """Returns a checkpoint of the nesting stack.
+
+    Instead of deep copying the stack, the blocks are shared between the
+    checkpoint and the stack, and marked as frozen.  A frozen block is
+    copied by _InnermostBlock the first time it needs to be modified, so
+    the checkpoint never changes.
+
+    Returns:
+      A tuple with the blocks of the nesting stack.
+    """
+    for block in self.stack:
+      block.frozen = True
+    return tuple(self.stack)
+
+  def _InnermostBlock(self):
+    """Returns the innermost block, ready to be modified.
+
+    Returns:
+      The top of the stack, replaced by its copy first if it is frozen.
+    """
+    block = self.stack[-1]
+    if block.frozen:
+      block = copy.copy(block)
+      block.frozen = False
+      self.stack[-1] = block
+    return block
+
   def SeenOpenBrace(self):
     """Check if we have seen the opening brace for the innermost block.
 
@@ -1549,7 +1912,7 @@ class _NestingState(object):
     if Match(r'^\s*#\s*(if|ifdef|ifndef)\b', line):
       # Beginning of #if block, save the nesting stack here.  The saved
       # stack will allow us to restore the parsing state in the #else case.
-      self.pp_stack.append(_PreprocessorInfo(copy.deepcopy(self.stack)))
+      self.pp_stack.append(_PreprocessorInfo(self._SaveStack()))
     elif Match(r'^\s*#\s*(else|elif)\b', line):
       # Beginning of #else block
       if self.pp_stack:
@@ -1558,10 +1921,10 @@ class _NestingState(object):
           # whole nesting stack up to this point.  This is what we
           # keep after the #endif.
           self.pp_stack[-1].seen_else = True
-          self.pp_stack[-1].stack_before_else = copy.deepcopy(self.stack)
+          self.pp_stack[-1].stack_before_else = self._SaveStack()
 
         # Restore the stack to how it was before the #if
-        self.stack = copy.deepcopy(self.pp_stack[-1].stack_before_if)
+        self.stack = list(self.pp_stack[-1].stack_before_if)
       else:
         # TODO(unknown): unexpected #else, issue warning?
         pass
@@ -1572,9 +1935,9 @@ class _NestingState(object):
         # stack to its former state before the #else, otherwise we
         # will just continue from where we left off.
         if self.pp_stack[-1].seen_else:
-          # Here we can just use a shallow copy since we are the last
-          # reference to it.
-          self.stack = self.pp_stack[-1].stack_before_else
+          # The saved blocks stay frozen, but we are the last reference to
+          # them, so they will be copied at most once more.
+          self.stack = list(self.pp_stack[-1].stack_before_else)
         # Drop the corresponding #if
         self.pp_stack.pop()
       else:
@@ -1598,7 +1961,7 @@ class _NestingState(object):
     # Count parentheses.  This is to avoid adding struct arguments to
     # the nesting stack.
     if self.stack:
-      inner_block = self.stack[-1]
+      inner_block = self._InnermostBlock()
       depth_change = line.count('(') - line.count(')')
       inner_block.open_parentheses += depth_change
 
@@ -1673,13 +2036,13 @@ class _NestingState(object):
     # If we have not yet seen the opening brace for the innermost block,
     # run checks here.
     if not self.SeenOpenBrace():
-      self.stack[-1].CheckBegin(filename, clean_lines, linenum, error)
+      self._InnermostBlock().CheckBegin(filename, clean_lines, linenum, error)
 
     # Update access control if we are inside a class/struct
     if self.stack and isinstance(self.stack[-1], _ClassInfo):
       access_match = Match(r'\s*(public|private|protected)(| signals| slots)\s*:', line)
       if access_match:
-        self.stack[-1].access = access_match.group(1)
+        self._InnermostBlock().access = access_match.group(1)
 
     # Consume braces or semicolons from what's left of the line
     while True:
@@ -1694,7 +2057,7 @@ class _NestingState(object):
         # namespace/class head as complete.  Push a new block onto the
         # stack otherwise.
         if not self.SeenOpenBrace():
-          self.stack[-1].seen_open_brace = True
+          self._InnermostBlock().seen_open_brace = True
         else:
           self.stack.append(_BlockInfo(True))
           if _MATCH_ASM.match(line):
@@ -3551,25 +3914,55 @@ _HEADERS_CONTAINING_TEMPLATES = (
 
 _RE_PATTERN_STRING = re.compile(r'\bstring\b')
 
+# Every pattern below can only match a line that contains its template name
+# as a whole word, so each list comes with an index from template names to
+# positions in the list.  CheckForIncludeWhatYouUse splits a line into words
+# once and only tries the patterns of the template names found there.
+_RE_PATTERN_WORD = re.compile(r'\w+')
+
 _re_pattern_algorithm_header = []
+_re_pattern_algorithm_header_index = {}
 for _template in ('copy', 'max', 'min', 'min_element', 'sort', 'swap',
                   'transform'):
   # Match max<type>(..., ...), max(..., ...), but not foo->max, foo.max or
   # type::max().
+  _re_pattern_algorithm_header_index.setdefault(_template, []).append(
+      len(_re_pattern_algorithm_header))
   _re_pattern_algorithm_header.append(
       (re.compile(r'[^>.]\b' + _template + r'(<.*?>)?\([^\)]'),
        _template,
        '<algorithm>'))
 
 _re_pattern_templates = []
+_re_pattern_templates_index = {}
 for _header, _templates in _HEADERS_CONTAINING_TEMPLATES:
   for _template in _templates:
+    _re_pattern_templates_index.setdefault(_template, []).append(
+        len(_re_pattern_templates))
     _re_pattern_templates.append(
         (re.compile(r'(\<|\b)' + _template + r'\s*\<'),
          _template + '<>',
          _header))
 
 
+def _CandidatePatterns(words, patterns, index):
+  """Returns the patterns that may match a line, in their original order.
+
+  Args:
+    words: The set of words found on the line.
+    patterns: A list of (pattern, template, header) tuples.
+    index: A dict mapping template names to positions in patterns.
+
+  Returns:
+    The sublist of patterns whose template name is one of words.
+  """
+  positions = []
+  for word in words:
+    positions.extend(index.get(word, ()))
+  positions.sort()
+  return [patterns[position] for position in positions]
+
+
 def FilesBelongToSameModule(filename_cc, filename_h):
   """Check if these two filenames belong to the same module.
 
@@ -3641,6 +4034,9 @@ def UpdateIncludeState(filename, include_state, io=codecs):
     headerfile = io.open(filename, 'r', 'utf8', 'replace')
   except IOError:
     return False
+  finally:
+    if _include_dependencies is not None:
+      _include_dependencies.append(filename)
   linenum = 0
   for line in headerfile:
     linenum += 1
@@ -3689,7 +4085,11 @@ def CheckForIncludeWhatYouUse(filename, clean_lines, include_state, error,
       if prefix.endswith('std::') or not prefix.endswith('::'):
         required['<string>'] = (linenum, 'string')
 
-    for pattern, template, header in _re_pattern_algorithm_header:
+    words = set(_RE_PATTERN_WORD.findall(line))
+
+    for pattern, template, header in _CandidatePatterns(
+        words, _re_pattern_algorithm_header,
+        _re_pattern_algorithm_header_index):
       if pattern.search(line):
         required[header] = (linenum, template)
 
@@ -3697,7 +4097,8 @@ def CheckForIncludeWhatYouUse(filename, clean_lines, include_state, error,
     if not '<' in line:  # Reduces the cpu time usage by skipping lines.
       continue
 
-    for pattern, template, header in _re_pattern_templates:
+    for pattern, template, header in _CandidatePatterns(
+        words, _re_pattern_templates, _re_pattern_templates_index):
       if pattern.search(line):
         required[header] = (linenum, template)
 
@@ -3772,6 +4173,48 @@ def CheckMakePairUsesDeduction(filename, clean_lines, linenum, error):
           ' OR use pair directly OR if appropriate, construct a pair directly')
 
 
+# Categories of the errors that each of the following checks may report.
+# When all of them are filtered out, the check is not run at all.  Only checks
+# that don't update any state used by other checks can be listed here; for
+# instance CheckLanguage can't, since it fills the include state, nor can
+# CheckForHeaderGuard, since it parses NOLINT comments.
+_CHECK_CATEGORIES = {
+    CheckForCopyright: ('legal/copyright',),
+    CheckForFunctionLengths: ('readability/fn_size',),
+    CheckForMultilineCommentsAndStrings: ('readability/multiline_comment',
+                                          'readability/multiline_string'),
+    CheckStyle: ('readability/alt_tokens', 'readability/braces',
+                 'readability/check', 'readability/constructors',
+                 'readability/todo', 'whitespace/blank_line',
+                 'whitespace/braces', 'whitespace/comma',
+                 'whitespace/comments', 'whitespace/empty_loop_body',
+                 'whitespace/end_of_line', 'whitespace/forcolon',
+                 'whitespace/indent', 'whitespace/labels',
+                 'whitespace/line_length', 'whitespace/newline',
+                 'whitespace/operators', 'whitespace/parens',
+                 'whitespace/semicolon', 'whitespace/tab', 'whitespace/todo'),
+    CheckForNonStandardConstructs: ('build/deprecated', 'build/endif_comment',
+                                    'build/forward_decl',
+                                    'build/printf_format',
+                                    'build/storage_class', 'runtime/explicit',
+                                    'runtime/member_string_references',
+                                    'runtime/printf_format'),
+    CheckPosixThreading: ('runtime/threadsafe_fn',),
+    CheckInvalidIncrement: ('runtime/invalid_increment',),
+    CheckMakePairUsesDeduction: ('build/explicit_make_pair',),
+    CheckForIncludeWhatYouUse: ('build/include_what_you_use',),
+    CheckForUnicodeReplacementCharacters: ('readability/utf8',),
+    CheckForNewlineAtEOF: ('whitespace/ending_newline',),
+    }
+
+
+def _ShouldRunCheck(check_fn):
+  """Returns False if every error the check may report is filtered out."""
+  categories = _CHECK_CATEGORIES.get(check_fn)
+  return (categories is None or
+          not _cpplint_state.AreAllCategoriesFiltered(categories))
+
+
 def ProcessLine(filename, file_extension, clean_lines, line,
                 include_state, function_state, nesting_state, error,
                 extra_check_functions=[]):
@@ -3798,21 +4241,55 @@ def ProcessLine(filename, file_extension, clean_lines, line,
   nesting_state.Update(filename, clean_lines, line, error)
   if nesting_state.stack and nesting_state.stack[-1].inline_asm != _NO_ASM:
     return
-  CheckForFunctionLengths(filename, clean_lines, line, function_state, error)
-  CheckForMultilineCommentsAndStrings(filename, clean_lines, line, error)
-  CheckStyle(filename, clean_lines, line, file_extension, nesting_state, error)
+  if _ShouldRunCheck(CheckForFunctionLengths):
+    CheckForFunctionLengths(filename, clean_lines, line, function_state, error)
+  if _ShouldRunCheck(CheckForMultilineCommentsAndStrings):
+    CheckForMultilineCommentsAndStrings(filename, clean_lines, line, error)
+  if _ShouldRunCheck(CheckStyle):
+    CheckStyle(filename, clean_lines, line, file_extension, nesting_state,
+               error)
   CheckLanguage(filename, clean_lines, line, file_extension, include_state,
                 error)
-  CheckForNonStandardConstructs(filename, clean_lines, line,
-                                nesting_state, error)
-  CheckPosixThreading(filename, clean_lines, line, error)
-  CheckInvalidIncrement(filename, clean_lines, line, error)
-  CheckMakePairUsesDeduction(filename, clean_lines, line, error)
+  if _ShouldRunCheck(CheckForNonStandardConstructs):
+    CheckForNonStandardConstructs(filename, clean_lines, line,
+                                  nesting_state, error)
+  if _ShouldRunCheck(CheckPosixThreading):
+    CheckPosixThreading(filename, clean_lines, line, error)
+  if _ShouldRunCheck(CheckInvalidIncrement):
+    CheckInvalidIncrement(filename, clean_lines, line, error)
+  if _ShouldRunCheck(CheckMakePairUsesDeduction):
+    CheckMakePairUsesDeduction(filename, clean_lines, line, error)
   for check_fn in extra_check_functions:
     check_fn(filename, clean_lines, line, error)
 
+def _UpdateLineState(filename, clean_lines, line, include_state,
+                     function_state, nesting_state, error):
+  """Updates the state ProcessLine keeps across lines, without other checks.
+
+  Used for the lines that are not checked in --diff-base mode, so that
+  the checks of the other lines still see the right nesting, function and
+  include state.
+
+  Args:
+    filename: Filename of the file that is being processed.
+    clean_lines: A CleansedLines instance containing the file.
+    line: Number of line being processed.
+    include_state: An _IncludeState instance in which the headers are inserted.
+    function_state: A _FunctionState instance which counts function lines, etc.
+    nesting_state: A _NestingState instance which maintains information about
+                   the current stack of nested blocks being parsed.
+    error: A callable to which errors are reported.
+  """
+  nesting_state.Update(filename, clean_lines, line, error)
+  if nesting_state.stack and nesting_state.stack[-1].inline_asm != _NO_ASM:
+    return
+  CheckForFunctionLengths(filename, clean_lines, line, function_state, error)
+  if _RE_PATTERN_INCLUDE.search(clean_lines.elided[line]):
+    CheckIncludeLine(filename, clean_lines, line, include_state, error)
+
+
 def ProcessFileData(filename, file_extension, lines, error,
-                    extra_check_functions=[]):
+                    extra_check_functions=[], changed_lines=None):
   """Performs lint checks and reports any errors to the given error function.
 
   Args:
@@ -3825,17 +4302,28 @@ def ProcessFileData(filename, file_extension, lines, error,
     extra_check_functions: An array of additional check functions that will be
                            run on each source line. Each function takes 4
                            arguments: filename, clean_lines, line, error
+    changed_lines: A set of line numbers, or None.  If given, only errors on
+                   these lines are reported, and only these lines are passed
+                   to ProcessLine.
   """
   lines = (['// marker so line numbers and indices both start at 1'] + lines +
            ['// marker so line numbers end in a known way'])
 
+  if changed_lines is not None:
+    report_error = error
+
+    def error(filename, linenum, category, confidence, message):
+      if linenum in changed_lines:
+        report_error(filename, linenum, category, confidence, message)
+
   include_state = _IncludeState()
   function_state = _FunctionState()
   nesting_state = _NestingState()
 
   ResetNolintSuppressions()
 
-  CheckForCopyright(filename, lines, error)
+  if _ShouldRunCheck(CheckForCopyright):
+    CheckForCopyright(filename, lines, error)
 
   if file_extension == 'h':
     CheckForHeaderGuard(filename, lines, error)
@@ -3843,18 +4331,51 @@ def ProcessFileData(filename, file_extension, lines, error,
   RemoveMultiLineComments(filename, lines, error)
   clean_lines = CleansedLines(lines)
   for line in xrange(clean_lines.NumLines()):
-    ProcessLine(filename, file_extension, clean_lines, line,
-                include_state, function_state, nesting_state, error,
-                extra_check_functions)
+    if changed_lines is None or line in changed_lines:
+      ProcessLine(filename, file_extension, clean_lines, line,
+                  include_state, function_state, nesting_state, error,
+                  extra_check_functions)
+    else:
+      _UpdateLineState(filename, clean_lines, line, include_state,
+                       function_state, nesting_state, error)
   nesting_state.CheckClassFinished(filename, error)
 
-  CheckForIncludeWhatYouUse(filename, clean_lines, include_state, error)
+  if _ShouldRunCheck(CheckForIncludeWhatYouUse):
+    CheckForIncludeWhatYouUse(filename, clean_lines, include_state, error)
 
   # We check here rather than inside ProcessLine so that we see raw
   # lines rather than "cleaned" lines.
-  CheckForUnicodeReplacementCharacters(filename, lines, error)
+  if _ShouldRunCheck(CheckForUnicodeReplacementCharacters):
+    CheckForUnicodeReplacementCharacters(filename, lines, error)
+
+  if _ShouldRunCheck(CheckForNewlineAtEOF):
+    CheckForNewlineAtEOF(filename, lines, error)
+
+def _ReadLines(source):
+  """Reads the lines of a UTF-8 encoded file.
+
+  The result is the same as the one of
+  source.read().decode('utf8', 'replace').split('\\n'), but lines are
+  decoded one by one, so the whole text of the file is never held in memory
+  next to its lines.
+
+  Args:
+    source: A file object opened in binary mode.
+
+  Returns:
+    The list of decoded lines, without the '\\n' separators.
+  """
+  lines = []
+  ends_with_newline = True
+  for raw_line in source:
+    ends_with_newline = raw_line.endswith('\n')
+    if ends_with_newline:
+      raw_line = raw_line[:-1]
+    lines.append(raw_line.decode('utf8', 'replace'))
+  if ends_with_newline:
+    lines.append(u'')
+  return lines
 
-  CheckForNewlineAtEOF(filename, lines, error)
 
 def ProcessFile(filename, vlevel, extra_check_functions=[]):
   """Does google-lint on a single file.
@@ -3884,19 +4405,18 @@ def ProcessFile(filename, vlevel, extra_check_functions=[]):
     # is processed.
 
     if filename == '-':
-      lines = codecs.StreamReaderWriter(sys.stdin,
-                                        codecs.getreader('utf8'),
-                                        codecs.getwriter('utf8'),
-                                        'replace').read().split('\n')
+      lines = _ReadLines(sys.stdin)
     else:
-      lines = codecs.open(filename, 'r', 'utf8', 'replace').read().split('\n')
+      with open(filename, 'rb') as source:
+        lines = _ReadLines(source)
 
-    carriage_return_found = False
-    # Remove trailing '\r'.
+    # Remove trailing '\r', remembering the (1-based) lines that had it.
+    carriage_return_lines = set()
     for linenum in range(len(lines)):
       if lines[linenum].endswith('\r'):
         lines[linenum] = lines[linenum].rstrip('\r')
-        carriage_return_found = True
+        carriage_return_lines.add(linenum + 1)
+    carriage_return_found = bool(carriage_return_lines)
 
   except IOError:
     sys.stderr.write(
@@ -3911,19 +4431,505 @@ def ProcessFile(filename, vlevel, extra_check_functions=[]):
   if (filename != '-' and file_extension != 'cc' and file_extension != 'h'
       and file_extension != 'cpp'):
     sys.stderr.write('Ignoring %s; not a .cc or .h file\n' % filename)
+  elif _diff_base is not None and filename != '-':
+    changed_lines = _ChangedLines(filename)
+    # Files without changes can't have errors on changed lines.
+    if changed_lines is None or changed_lines:
+      if changed_lines is not None:
+        # The \r of lines nobody touched is not reported either.
+        carriage_return_found = bool(carriage_return_lines & changed_lines)
+      _LintLines(filename, file_extension, lines, carriage_return_found, Error,
+                 extra_check_functions, changed_lines)
+  elif _cache_dir is None or filename == '-' or extra_check_functions:
+    _LintLines(filename, file_extension, lines, carriage_return_found, Error,
+               extra_check_functions)
   else:
-    ProcessFileData(filename, file_extension, lines, Error,
-                    extra_check_functions)
-    if carriage_return_found and os.linesep != '\r\n':
-      # Use 0 for linenum since outputting only one error for potentially
-      # several lines.
-      Error(filename, 0, 'whitespace/newline', 1,
-            'One or more unexpected \\r (^M) found;'
-            'better to use only a \\n')
+    cache_key = _CacheKey(filename, lines, carriage_return_found)
+    if not _ReplayCachedErrors(cache_key):
+      _LintAndCacheLines(cache_key, filename, file_extension, lines,
+                         carriage_return_found)
 
   sys.stderr.write('Done processing %s\n' % filename)
 
 
+def _ChangedLines(filename):
+  """Finds the lines of a file changed since the --diff-base revision.
+
+  Args:
+    filename: The name of the file.
+
+  Returns:
+    The set of the numbers of lines changed or added since _diff_base, or
+    None if the whole file should be linted.
+  """
+  directory = os.path.dirname(os.path.abspath(filename))
+  basename = os.path.basename(filename)
+  devnull = open(os.devnull, 'w')
+  try:
+    try:
+      subprocess.check_call(['git', 'ls-files', '--error-unmatch', basename],
+                            cwd=directory, stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+      # Not tracked by git, so every line is new.
+      return None
+    try:
+      diff = subprocess.check_output(
+          ['git', 'diff', '-U0', '--no-color', '--no-ext-diff', _diff_base,
+           '--', basename], cwd=directory, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+      sys.stderr.write("Can't diff '%s' against %s; linting all of it\n" %
+                       (filename, _diff_base))
+      return None
+  finally:
+    devnull.close()
+  changed_lines = set()
+  for match in _RE_PATTERN_DIFF_HUNK.finditer(diff.decode('utf8', 'replace')):
+    start = int(match.group(1))
+    if match.group(2) is None:
+      count = 1
+    else:
+      count = int(match.group(2))
+    changed_lines.update(xrange(start, start + count))
+  return changed_lines
+
+
+def _LintLines(filename, file_extension, lines, carriage_return_found, error,
+               extra_check_functions=[], changed_lines=None):
+  """Runs all the checks on the lines of a file that was read successfully.
+
+  Args:
+    filename: The name of the file being linted.
+    file_extension: The extension (dot not included) of the file.
+    lines: The lines of the file, with trailing '\\r' removed.
+    carriage_return_found: Whether any trailing '\\r' was removed.
+    error: The function to call with any errors found.
+    extra_check_functions: An array of additional check functions that will be
+                           run on each source line. Each function takes 4
+                           arguments: filename, clean_lines, line, error
+    changed_lines: A set of line numbers to limit the checks to, or None.
+  """
+  ProcessFileData(filename, file_extension, lines, error,
+                  extra_check_functions, changed_lines)
+  if carriage_return_found and os.linesep != '\r\n':
+    # Use 0 for linenum since outputting only one error for potentially
+    # several lines.
+    error(filename, 0, 'whitespace/newline', 1,
+          'One or more unexpected \\r (^M) found;'
+          'better to use only a \\n')
+
+
+_cpplint_fingerprint = None
+
+
+def _CpplintFingerprint():
+  """Returns a hash of cpplint itself, so that upgrades invalidate the cache."""
+  global _cpplint_fingerprint
+  if _cpplint_fingerprint is None:
+    try:
+      with open(os.path.abspath(__file__), 'rb') as source:
+        _cpplint_fingerprint = hashlib.sha1(source.read()).hexdigest()
+    except (IOError, NameError):
+      _cpplint_fingerprint = ''
+  return _cpplint_fingerprint
+
+
+def _HashFile(filename):
+  """Returns the hash of the contents of a file, or None if it can't be read."""
+  try:
+    with open(filename, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  except IOError:
+    return None
+
+
+def _CacheKey(filename, lines, carriage_return_found):
+  """Computes the cache key of a file with the current settings.
+
+  Args:
+    filename: The name of the file, as given on the command line.
+    lines: The lines of the file, with trailing '\\r' removed.
+    carriage_return_found: Whether any trailing '\\r' was removed.
+
+  Returns:
+    A hex digest identifying the lint results of this file.
+  """
+  content = hashlib.sha1('\n'.join(lines).encode('utf8')).hexdigest()
+  # The header guards expected in a file depend on the root of its checkout.
+  repository_root = _FindRepositoryRoot(
+      os.path.dirname(os.path.abspath(filename)))
+  settings = json.dumps([
+      _CpplintFingerprint(), filename, os.path.abspath(filename), content,
+      repository_root, carriage_return_found, _cpplint_state.filters, _root,
+      _cpplint_state.verbose_level, os.linesep])
+  return hashlib.sha1(settings.encode('utf8')).hexdigest()
+
+
+def _ReplayCachedErrors(cache_key):
+  """Prints the errors stored in the cache for the given key.
+
+  Args:
+    cache_key: The key computed by _CacheKey.
+
+  Returns:
+    True if the entry was found and replayed, False on a cache miss.
+  """
+  entry_path = os.path.join(_cache_dir, cache_key)
+  try:
+    with open(entry_path, 'rb') as entry_file:
+      entry = json.loads(entry_file.read().decode('utf8'))
+    # Entries of .cc files also depend on the headers that were read.
+    for header, header_hash in entry['dependencies']:
+      if _HashFile(header) != header_hash:
+        return False
+    # Mark the entry as recently used.
+    os.utime(entry_path, None)
+  except (IOError, OSError, ValueError, KeyError, TypeError):
+    return False
+  for filename, linenum, category, confidence, message in entry['errors']:
+    _PrintError(filename, linenum, category, confidence, message)
+  return True
+
+
+def _LintAndCacheLines(cache_key, filename, file_extension, lines,
+                       carriage_return_found):
+  """Lints the lines of a file and stores the printed errors in the cache.
+
+  Args:
+    cache_key: The key computed by _CacheKey.
+    filename: The name of the file being linted.
+    file_extension: The extension (dot not included) of the file.
+    lines: The lines of the file, with trailing '\\r' removed.
+    carriage_return_found: Whether any trailing '\\r' was removed.
+  """
+  global _include_dependencies
+  errors = []
+
+  def RecordError(filename, linenum, category, confidence, message):
+    if _ShouldPrintError(category, confidence, linenum):
+      errors.append((filename, linenum, category, confidence, message))
+      _PrintError(filename, linenum, category, confidence, message)
+
+  _include_dependencies = []
+  try:
+    _LintLines(filename, file_extension, lines, carriage_return_found,
+               RecordError)
+    dependencies = [(header, _HashFile(header))
+                    for header in _include_dependencies]
+  finally:
+    _include_dependencies = None
+
+  entry = json.dumps({'dependencies': dependencies, 'errors': errors})
+  try:
+    if not os.path.isdir(_cache_dir):
+      os.makedirs(_cache_dir)
+    # Write to a temporary file first, so that concurrent runs never see
+    # half-written entries.
+    fd, temp_path = tempfile.mkstemp(dir=_cache_dir, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as entry_file:
+      entry_file.write(entry.encode('utf8'))
+    os.rename(temp_path, os.path.join(_cache_dir, cache_key))
+  except (IOError, OSError):
+    # The cache is only an optimization, failing to write it is fine.
+    pass
+
+
+def TrimCache(max_bytes=_CACHE_MAX_BYTES):
+  """Removes least recently used cache entries until the cache fits.
+
+  Args:
+    max_bytes: The maximum total size of the cache entries.
+  """
+  if _cache_dir is None:
+    return
+  entries = []
+  total_size = 0
+  try:
+    for name in os.listdir(_cache_dir):
+      entry_stat = os.stat(os.path.join(_cache_dir, name))
+      entries.append((entry_stat.st_mtime, entry_stat.st_size, name))
+      total_size += entry_stat.st_size
+  except OSError:
+    return
+  entries.sort()
+  for _, size, name in entries:
+    if total_size <= max_bytes:
+      break
+    try:
+      os.remove(os.path.join(_cache_dir, name))
+    except OSError:
+      pass
+    total_size -= size
+
+
+class _OutputBuffer(ErrorSink):
+  """Collects messages and errors, in order, instead of printing them.
+
+  It replaces both sys.stderr and the ErrorSink in worker processes.  Each
+  chunk is either a message written to stderr, or a tuple with the
+  arguments of an error.
+  """
+
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, text):
+    self.chunks.append(text)
+
+  def Write(self, filename, linenum, category, confidence, message):
+    self.chunks.append((filename, linenum, category, confidence, message))
+
+
+def _InitLintWorker(verbose_level, output_format, filters, counting, root,
+                    cache_dir, diff_base):
+  """Copies the module-wide settings of the parent into a worker process.
+
+  Every worker is a separate process, so it has its own _CppLintState and
+  its own NOLINT suppression table; only the settings have to be passed.
+
+  Args:
+    verbose_level: The verbosity level of the parent.
+    output_format: The output format of the parent.
+    filters: The list of filters (including defaults) of the parent.
+    counting: The counting style of the parent.
+    root: The --root value of the parent.
+    cache_dir: The cache directory of the parent.
+    diff_base: The --diff-base value of the parent.
+  """
+  global _root, _cache_dir, _diff_base
+  _cpplint_state.SetVerboseLevel(verbose_level)
+  _cpplint_state.SetOutputFormat(output_format)
+  _cpplint_state.SetFilterList(filters)
+  _cpplint_state.SetCountingStyle(counting)
+  _root = root
+  _cache_dir = cache_dir
+  _diff_base = diff_base
+
+
+def _ProcessFileInWorker(filename):
+  """Lints one file in a worker process, buffering all of its output.
+
+  Args:
+    filename: The name of the file to parse.
+
+  Returns:
+    A tuple of (output, error_count, category_counts, profile), where
+    output is the list of messages written to stderr and errors, in the
+    order of a serial run, category_counts is a list of (category, count)
+    pairs in the order in which the categories were first seen, and profile
+    is the result of _Profiler.Stats for this file, or None.
+  """
+  _cpplint_state.ResetErrorCounts()
+  # Remember the order in which categories are seen, so that the parent
+  # can merge the counts exactly as a serial run would accumulate them.
+  _cpplint_state.errors_by_category = collections.OrderedDict()
+  output = _OutputBuffer()
+  stderr = sys.stderr
+  sys.stderr = output
+  error_sink = _cpplint_state.SetErrorSink(output)
+  if _profiler:
+    _profiler.Reset()
+  try:
+    ProcessFile(filename, _cpplint_state.verbose_level)
+  finally:
+    sys.stderr = stderr
+    _cpplint_state.SetErrorSink(error_sink)
+  return (output.chunks, _cpplint_state.error_count,
+          list(_cpplint_state.errors_by_category.items()),
+          _profiler and _profiler.Stats())
+
+
+def ProcessFilesInParallel(filenames, jobs):
+  """Lints the files using a pool of worker processes.
+
+  Results are written and counted in the order of filenames, so the output
+  and the error counts are the same as the ones of a serial run.
+
+  Args:
+    filenames: The names of the files to parse.
+    jobs: The number of worker processes to use.
+  """
+  pool = multiprocessing.Pool(
+      min(jobs, len(filenames)), _InitLintWorker,
+      (_cpplint_state.verbose_level, _cpplint_state.output_format,
+       _cpplint_state.filters, _cpplint_state.counting, _root, _cache_dir,
+       _diff_base))
+  try:
+    for output, error_count, category_counts, profile in pool.imap(
+        _ProcessFileInWorker, filenames):
+      for chunk in output:
+        if isinstance(chunk, tuple):
+          _cpplint_state.error_sink.Write(*chunk)
+        else:
+          sys.stderr.write(chunk)
+      _cpplint_state.error_count += error_count
+      for category, count in category_counts:
+        if category not in _cpplint_state.errors_by_category:
+          _cpplint_state.errors_by_category[category] = 0
+        _cpplint_state.errors_by_category[category] += count
+      if profile:
+        _profiler.Merge(profile)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+# Functions timed by --profile.  Files are timed through ProcessFile.
+_PROFILED_FUNCTIONS = (
+    'ParseNolintSuppressions', 'RemoveMultiLineComments', 'CheckForCopyright',
+    'CheckForHeaderGuard', 'CheckForFunctionLengths',
+    'CheckForMultilineCommentsAndStrings', 'CheckStyle', 'CheckSpacing',
+    'CheckSectionSpacing', 'CheckBraces', 'CheckEmptyLoopBody', 'CheckCheck',
+    'CheckAltTokens', 'CheckAccess', 'CheckLanguage', 'CheckIncludeLine',
+    'CheckCStyleCast', 'CheckForNonStandardConstructs', 'CheckPosixThreading',
+    'CheckInvalidIncrement', 'CheckMakePairUsesDeduction',
+    'CheckForIncludeWhatYouUse', 'CheckForUnicodeReplacementCharacters',
+    'CheckForNewlineAtEOF',
+    )
+
+
+class _Profiler(object):
+  """Measures where cpplint spends its time, for --profile.
+
+  Install replaces the profiled functions of this module, Match and Search
+  with instrumented versions.  The callers look them up by name, so they
+  call the instrumented versions without any change.
+  """
+
+  def __init__(self):
+    self.Reset()
+
+  def Reset(self):
+    """Forgets everything measured so far."""
+    self.checks = {}  # function name to [calls, seconds]
+    self.files = {}  # file name to seconds
+    self.regexp_lookups = 0
+    self.regexp_misses = 0
+    self.regexp_cache_size = 0
+
+  def _Measure(self, name, function):
+    """Returns a wrapper of function that adds its calls to self.checks."""
+    profiler = self
+
+    def Measured(*args, **kwargs):
+      start = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        elapsed = time.time() - start
+        measurement = profiler.checks.get(name)
+        if measurement is None:
+          measurement = profiler.checks[name] = [0, 0.0]
+        measurement[0] += 1
+        measurement[1] += elapsed
+    Measured.__name__ = function.__name__
+    Measured.__doc__ = function.__doc__
+    return Measured
+
+  def Install(self):
+    """Instruments the functions of this module."""
+    module = sys.modules[__name__]
+    profiler = self
+    for name in _PROFILED_FUNCTIONS:
+      function = getattr(module, name)
+      measured = self._Measure(name, function)
+      setattr(module, name, measured)
+      if function in _CHECK_CATEGORIES:
+        _CHECK_CATEGORIES[measured] = _CHECK_CATEGORIES[function]
+    _NestingState.Update = self._Measure(
+        '_NestingState.Update', _NestingState.__dict__['Update'])
+
+    process_file = module.ProcessFile
+
+    def MeasuredProcessFile(filename, *args, **kwargs):
+      start = time.time()
+      try:
+        return process_file(filename, *args, **kwargs)
+      finally:
+        profiler.files[filename] = (profiler.files.get(filename, 0.0) +
+                                    time.time() - start)
+        profiler.regexp_cache_size = len(_regexp_compile_cache)
+    module.ProcessFile = MeasuredProcessFile
+
+    def CountingMatch(pattern, s):
+      profiler.regexp_lookups += 1
+      if not pattern in _regexp_compile_cache:
+        profiler.regexp_misses += 1
+        _regexp_compile_cache[pattern] = sre_compile.compile(pattern)
+      return _regexp_compile_cache[pattern].match(s)
+    module.Match = CountingMatch
+
+    def CountingSearch(pattern, s):
+      profiler.regexp_lookups += 1
+      if not pattern in _regexp_compile_cache:
+        profiler.regexp_misses += 1
+        _regexp_compile_cache[pattern] = sre_compile.compile(pattern)
+      return _regexp_compile_cache[pattern].search(s)
+    module.Search = CountingSearch
+
+  def Stats(self):
+    """Returns everything measured so far, as a JSON-compatible dict."""
+    if self.regexp_lookups:
+      hit_rate = 1.0 - float(self.regexp_misses) / self.regexp_lookups
+    else:
+      hit_rate = 0.0
+    return {
+        'checks': dict((name, {'calls': calls, 'seconds': seconds})
+                       for name, (calls, seconds) in self.checks.items()),
+        'files': dict(self.files),
+        'regexp_cache': {
+            'size': self.regexp_cache_size,
+            'lookups': self.regexp_lookups,
+            'hits': self.regexp_lookups - self.regexp_misses,
+            'hit_rate': hit_rate,
+            },
+        }
+
+  def Merge(self, stats):
+    """Adds the result of Stats of another _Profiler, e.g. of a worker."""
+    for name, measurement in stats['checks'].items():
+      mine = self.checks.setdefault(name, [0, 0.0])
+      mine[0] += measurement['calls']
+      mine[1] += measurement['seconds']
+    for filename, seconds in stats['files'].items():
+      self.files[filename] = self.files.get(filename, 0.0) + seconds
+    regexp_cache = stats['regexp_cache']
+    self.regexp_lookups += regexp_cache['lookups']
+    self.regexp_misses += regexp_cache['lookups'] - regexp_cache['hits']
+    # Every worker has a cache of its own.
+    self.regexp_cache_size = max(self.regexp_cache_size, regexp_cache['size'])
+
+  def PrintReport(self, slowest_files=10):
+    """Writes the measurements, slowest first, to stderr.
+
+    Args:
+      slowest_files: How many of the slowest files to list.
+    """
+    stats = self.Stats()
+    sys.stderr.write('%-40s %10s %12s %14s\n' % (
+        'Check', 'Calls', 'Total (s)', 'Per call (us)'))
+    for name, measurement in sorted(
+        stats['checks'].items(), key=lambda item: -item[1]['seconds']):
+      sys.stderr.write('%-40s %10d %12.3f %14.1f\n' % (
+          name, measurement['calls'], measurement['seconds'],
+          1e6 * measurement['seconds'] / measurement['calls']))
+    sys.stderr.write('\n%-65s %12s\n' % ('File', 'Total (s)'))
+    for filename, seconds in sorted(
+        stats['files'].items(), key=lambda item: -item[1])[:slowest_files]:
+      sys.stderr.write('%-65s %12.3f\n' % (filename, seconds))
+    regexp_cache = stats['regexp_cache']
+    sys.stderr.write('\nRegexp cache: %d patterns, %d lookups, %.2f%% hits\n'
+                     % (regexp_cache['size'], regexp_cache['lookups'],
+                        100 * regexp_cache['hit_rate']))
+
+  def WriteJson(self, path):
+    """Dumps the measurements to a JSON file."""
+    with open(path, 'w') as json_file:
+      json.dump(self.Stats(), json_file, indent=2, sort_keys=True)
+
+
 def PrintUsage(message):
   """Prints a brief usage string and exits, optionally with an error message.
 
@@ -3961,7 +4967,11 @@ def ParseArguments(args):
     (opts, filenames) = getopt.getopt(args, '', ['help', 'output=', 'verbose=',
                                                  'counting=',
                                                  'filter=',
-                                                 'root='])
+                                                 'root=',
+                                                 'jobs=',
+                                                 'no-cache',
+                                                 'diff-base=',
+                                                 'profile='])
   except getopt.GetoptError:
     PrintUsage('Invalid arguments.')
 
@@ -3974,8 +4984,9 @@ def ParseArguments(args):
     if opt == '--help':
       PrintUsage(None)
     elif opt == '--output':
-      if not val in ('emacs', 'vs7', 'eclipse'):
-        PrintUsage('The only allowed output formats are emacs, vs7 and eclipse.')
+      if not val in ('emacs', 'vs7', 'eclipse', 'jsonl', 'sarif'):
+        PrintUsage('The only allowed output formats are emacs, vs7, eclipse,'
+                   ' jsonl and sarif.')
       output_format = val
     elif opt == '--verbose':
       verbosity = int(val)
@@ -3990,6 +5001,23 @@ def ParseArguments(args):
     elif opt == '--root':
       global _root
       _root = val
+    elif opt == '--jobs':
+      global _jobs
+      try:
+        _jobs = int(val)
+      except ValueError:
+        PrintUsage('Jobs must be a positive number.')
+      if _jobs < 1:
+        PrintUsage('Jobs must be a positive number.')
+    elif opt == '--no-cache':
+      global _cache_dir
+      _cache_dir = None
+    elif opt == '--diff-base':
+      global _diff_base
+      _diff_base = val
+    elif opt == '--profile':
+      global _profile_path
+      _profile_path = val
 
   if not filenames:
     PrintUsage('No files were specified.')
@@ -4012,10 +5040,23 @@ def main():
                                          codecs.getwriter('utf8'),
                                          'replace')
 
+  if _profile_path:
+    global _profiler
+    _profiler = _Profiler()
+    _profiler.Install()
+
   _cpplint_state.ResetErrorCounts()
-  for filename in filenames:
-    ProcessFile(filename, _cpplint_state.verbose_level)
+  if _jobs > 1 and len(filenames) > 1 and '-' not in filenames:
+    ProcessFilesInParallel(filenames, _jobs)
+  else:
+    for filename in filenames:
+      ProcessFile(filename, _cpplint_state.verbose_level)
+  TrimCache()
+  _cpplint_state.error_sink.Flush()
   _cpplint_state.PrintErrorCounts()
+  if _profiler:
+    _profiler.PrintReport()
+    _profiler.WriteJson(_profile_path)
 
   sys.exit(_cpplint_state.error_count > 0)
 
@@ -36,79 +36,310 @@
 #   my-added-provider:    # name to use when creating temporary dirs
 #       source:           # same as in before and after
 #       source-subdir:    # same as in before and after
+#
+# Instead of starting checkbox-cli for every query, a worker is started in the
+# interpreter of each venv (this very script run with --worker). It loads the
+# providers once and then calls checkbox-cli in-process for every query it
+# reads from a pipe, so the interpreter start, the imports and the loading of
+# the providers are paid only once per venv. Use --no-worker to start
+# checkbox-cli for every query instead.
+#
+# Test plans are bootstrapped by up to --jobs concurrent queries, their
+# comparisons are still printed in order. A venv gets another worker only
+# when a query finds all of its workers busy, so no more workers are started
+# than there are queries at the same time.
+#
+# With --shared-venv checkbox is built only once, in venv. venv-before and
+# venv-after then only hold an activate script, which activates venv with
+# PROVIDERPATH pointing to their own provider directory instead.
+#
+# With --compare-sorted BEFORE AFTER no providers are compared. Two files with
+# one item per line, sorted with `LC_ALL=C sort`, are compared instead, in one
+# pass and without reading them into memory.
 
 import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
 import os
+import queue
+import runpy
+import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
-import yaml
+import traceback
+
+try:
+    import yaml
+except ImportError:
+    # the worker runs in the venvs, which don't need to have yaml
+    yaml = None
+
+SCRIPT = os.path.abspath(__file__)
+# queues of idle workers by the name of their venv, when they're used
+WORKERS = {}
 
 
-def cmd(command, venv=None):
+def cmd(command, venv=None, cwd=None):
     if venv:
         command = '. venv-{}/bin/activate && '.format(venv) + command
-    return subprocess.check_output(command, shell=True)
+    return subprocess.check_output(command, shell=True, cwd=cwd)
+
+
+class Worker:
+    def __init__(self, venv):
+        self.venv = venv
+        self._proc = subprocess.Popen(
+            '. venv-{}/bin/activate && exec python3 {} --worker'.format(
+                venv, shlex.quote(SCRIPT)),
+            shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+
+    def run(self, args):
+        self._proc.stdin.write(json.dumps(args) + '\n')
+        self._proc.stdin.flush()
+        reply = self._proc.stdout.readline()
+        if not reply:
+            raise SystemExit("The worker of venv-{} died".format(self.venv))
+        reply = json.loads(reply)
+        if reply['status']:
+            raise subprocess.CalledProcessError(
+                reply['status'], ['checkbox-cli'] + args, reply['output'])
+        return reply['output']
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+
 
+def checkbox_cli(args, venv):
+    # run `checkbox-cli args` in the venv, return what it printed
+    if venv in WORKERS:
+        try:
+            worker = WORKERS[venv].get_nowait()
+        except queue.Empty:
+            worker = Worker(venv)
+        try:
+            return worker.run(args)
+        finally:
+            WORKERS[venv].put(worker)
+    out = cmd(' '.join(shlex.quote(arg) for arg in ['checkbox-cli'] + args),
+              venv)
+    return out.decode(sys.stdout.encoding)
 
-def setup(config):
+
+def serve():
+    # worker mode: for every JSON list of arguments read from stdin, run
+    # checkbox-cli with them and reply with its exit status and output
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'wt')
+    # anything printed around sys.stdout must not get into the replies
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    script = shutil.which('checkbox-cli')
+    main = checkbox_cli_main(script)
+    for line in sys.stdin:
+        sys.argv = [script] + json.loads(line)
+        output = io.StringIO()
+        status = 0
+        with contextlib.redirect_stdout(output):
+            try:
+                raise SystemExit(main())
+            except SystemExit as exc:
+                if isinstance(exc.code, int):
+                    status = exc.code
+                elif exc.code is not None:
+                    print(exc.code, file=sys.stderr)
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        channel.write(json.dumps(
+            {'status': status, 'output': output.getvalue()}) + '\n')
+        channel.flush()
+
+
+def checkbox_cli_main(script):
+    # plainbox keeps the providers it loaded for the whole process, so they
+    # are loaded here once and every query is then answered from them
+    try:
+        from plainbox.public import get_providers
+    except ImportError:
+        pass
+    else:
+        get_providers()
+    try:
+        import pkg_resources
+    except ImportError:
+        pkg_resources = None
+    if pkg_resources:
+        for entry_point in pkg_resources.iter_entry_points(
+                'console_scripts', 'checkbox-cli'):
+            return entry_point.load()
+
+    def run_script():
+        # not installed with an entry point, run the whole script every time
+        runpy.run_path(script, run_name='__main__')
+    return run_script
+
+
+def setup(config, shared_venv=False):
     # mkdtemp instead of TemporaryDirectory, so we control deletion
     tdir = tempfile.mkdtemp(dir=os.path.abspath(os.curdir))
     print("Using {} as the working directory".format(tdir))
     os.chmod(tdir, 0o755)
-    # pull before
-    os.chdir(tdir)
-    subprocess.check_call(
-        ['git', 'clone', config['before']['source'], 'before'])
-    os.chdir(os.path.join(
-        tdir, 'before', config['before'].get('source-subdir', '.')))
-    prov_installers_before = [
-        os.path.join(os.path.abspath(os.curdir), 'manage.py')]
-    subprocess.check_call(
-        ['git', 'checkout', config['before']['source-commit']])
-    # pull after
-    os.chdir(tdir)
-    subprocess.check_call(
-        ['git', 'clone', config['after']['source'], 'after'])
-    os.chdir(os.path.join(
-        tdir, 'after', config['after'].get('source-subdir', '.')))
-    prov_installers_after = [
-        os.path.join(os.path.abspath(os.curdir), 'manage.py')]
-    subprocess.check_call(
-        ['git', 'checkout', config['after']['source-commit']])
-    os.chdir(tdir)
-    subprocess.check_call(['../bootstrap-checkbox.sh'])
+    project = os.path.join(tdir, 'checkbox-project')
+    # mk-venv writes into the checkbox project, so the venv of 'after' is
+    # built from a copy of it, taken before either venv is started, to let
+    # both venvs be built at the same time
+    project_after = os.path.join(tdir, 'checkbox-project-after')
+    tasks = {
+        'bootstrap': (set(), lambda: subprocess.check_call(
+            ['../bootstrap-checkbox.sh'], cwd=tdir)),
+    }
+    if shared_venv:
+        tasks['venv'] = ({'bootstrap'}, lambda: subprocess.check_call(
+            ['./mk-venv', 'venv'], cwd=project))
+        for name in ['before', 'after']:
+            tasks['venv-' + name] = ({'venv'}, provider_set_task(
+                project, name))
+    else:
+        tasks['copy-project'] = ({'bootstrap'}, lambda: shutil.copytree(
+            project, project_after, symlinks=True))
+        tasks['venv-before'] = (
+            {'copy-project'}, lambda: subprocess.check_call(
+                ['./mk-venv', 'venv-before'], cwd=project))
+        tasks['venv-after'] = ({'copy-project'}, lambda: subprocess.check_call(
+            ['./mk-venv', '../checkbox-project/venv-after'],
+            cwd=project_after))
+    prov_installers = {'before': [], 'after': []}
+    for name in ['before', 'after']:
+        tasks['clone-' + name] = (set(), clone_task(
+            config[name]['source'], os.path.join(tdir, name),
+            config[name]['source-commit']))
+        prov_installers[name].append(('clone-' + name, os.path.join(
+            tdir, name, config[name].get('source-subdir', '.'), 'manage.py')))
     # get additional providers
     if config.get('additional_providers'):
         for prov in config.get('additional_providers', []):
             for name, params in prov.items():
-                subprocess.check_call(
-                    ['git', 'clone', params['source'], name])
-                manage_py_path = os.path.abspath(os.path.join(
-                    name, params.get('source-subdir', '.'), 'manage.py'))
-                prov_installers_before.append(manage_py_path)
-                prov_installers_after.append(manage_py_path)
-    # create venvs
-    os.chdir('checkbox-project')
-    subprocess.check_call(['./mk-venv', 'venv-before'])
-    for manage_py in prov_installers_before:
-        cmd('{} develop -d $PROVIDERPATH'.format(manage_py), 'before')
-    subprocess.check_call(['./mk-venv', 'venv-after'])
-    for manage_py in prov_installers_after:
-        cmd('{} develop -d $PROVIDERPATH'.format(manage_py), 'after')
+                tasks['clone-' + name] = (set(), clone_task(
+                    params['source'], os.path.join(tdir, name)))
+                manage_py_path = os.path.join(
+                    tdir, name, params.get('source-subdir', '.'), 'manage.py')
+                for venv in ['before', 'after']:
+                    prov_installers[venv].append(
+                        ('clone-' + name, manage_py_path))
+    # develop every provider as soon as it and its venv are ready
+    for venv, installers in prov_installers.items():
+        for clone, manage_py in installers:
+            tasks['develop-{}-{}'.format(venv, manage_py)] = (
+                {clone, 'venv-' + venv},
+                develop_task(manage_py, venv, project))
+    run_tasks(tasks)
+    os.chdir(project)
+
+
+def clone_task(source, path, commit=None):
+    def clone():
+        subprocess.check_call(['git', 'clone', source, path])
+        if commit:
+            subprocess.check_call(['git', 'checkout', commit], cwd=path)
+    return clone
+
+
+def provider_set_task(project, name):
+    def provider_set():
+        # venv-name activates the shared venv, but with its own providers,
+        # starting from the ones mk-venv developed into the shared venv
+        venv = os.path.join(project, 'venv-' + name)
+        providers = os.path.join(venv, 'share', 'plainbox-providers-1')
+        shutil.copytree(
+            os.path.join(project, 'venv', 'share', 'plainbox-providers-1'),
+            providers, symlinks=True)
+        os.makedirs(os.path.join(venv, 'bin'))
+        with open(os.path.join(venv, 'bin', 'activate'), 'wt') as f:
+            f.write('. {}\nexport PROVIDERPATH={}\n'.format(
+                shlex.quote(os.path.join(project, 'venv', 'bin', 'activate')),
+                shlex.quote(providers)))
+    return provider_set
+
+
+def develop_task(manage_py, venv, project):
+    return lambda: cmd(
+        '{} develop -d $PROVIDERPATH'.format(manage_py), venv, project)
+
+
+def run_tasks(tasks):
+    # tasks map names to (names of dependencies, function); every function
+    # is called once all its dependencies are done, as many at once as can be
+    done = set()
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        while len(done) < len(tasks):
+            for name, (dependencies, function) in sorted(tasks.items()):
+                if (name not in done and name not in running.values() and
+                        dependencies <= done):
+                    running[executor.submit(function)] = name
+            if not running:
+                raise SystemExit("Tasks {} can never run".format(
+                    ', '.join(sorted(set(tasks) - done))))
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                done.add(name)
 
 
 def main():
     parser = argparse.ArgumentParser("Plainbox Provider Comparison Tool")
     parser.add_argument(
         'configuration', nargs='?', default='provider_diff.yaml')
+    parser.add_argument(
+        '--no-worker', action='store_true',
+        help='Start checkbox-cli for every query')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='How many test plans to bootstrap at the same time')
+    parser.add_argument(
+        '--shared-venv', action='store_true',
+        help='Build checkbox once and only switch the providers')
+    parser.add_argument(
+        '--compare-sorted', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='Compare two sorted files instead of providers')
+    parser.add_argument(
+        '--worker', action='store_true', help=argparse.SUPPRESS)
     args = parser.parse_args()
+    if args.worker:
+        serve()
+        return
+    if args.compare_sorted:
+        compare_sorted_files(*args.compare_sorted)
+        return
+    if args.jobs < 1:
+        raise SystemExit("--jobs must be positive")
     if not os.path.isfile(args.configuration):
         raise SystemExit("Configuration file '{}' not found!".format(
             args.configuration))
+    if yaml is None:
+        raise SystemExit("PyYAML is needed to read the configuration")
     with open(args.configuration, 'rt') as f:
         config = yaml.load(f)
-    setup(config)
+    setup(config, args.shared_venv)
+    if not args.no_worker:
+        for venv in ['before', 'after']:
+            WORKERS[venv] = queue.Queue()
+    try:
+        compare_providers(args.jobs)
+    finally:
+        for workers in WORKERS.values():
+            while not workers.empty():
+                workers.get().close()
+
+
+def compare_providers(jobs):
     # compare static definition list for all jobs
     before_defs = get_job_definitions('before')
     after_defs = get_job_definitions('after')
@@ -119,40 +350,113 @@ def main():
     print("Comparing test plans")
     compare_sets(before_tps, after_tps)
     if before_tps == after_tps:
-        for tp in before_tps:
-            print("Comparing bootstrapped test plan {}".format(tp))
-            compare_sets(
-                list_bootstrapped('before', tp),
-                list_bootstrapped('after', tp))
+        compare_bootstrapped(before_tps, jobs)
+
+
+def compare_bootstrapped(test_plans, jobs):
+    # bootstrap concurrently, but print the comparisons in the order of
+    # test_plans as soon as each one is ready
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [
+            (tp, executor.submit(list_bootstrapped, 'before', tp),
+             executor.submit(list_bootstrapped, 'after', tp))
+            for tp in test_plans]
+        try:
+            for tp, before, after in futures:
+                before_list = before.result()
+                after_list = after.result()
+                print("Comparing bootstrapped test plan {}".format(tp))
+                compare_sets(before_list, after_list)
+        except BaseException:
+            for _, before, after in futures:
+                before.cancel()
+                after.cancel()
+            raise
 
 
 def compare_sets(before, after):
-    only_in_before = [x for x in before if x not in after]
-    only_in_after = [x for x in after if x not in before]
-    only_in_both = [x for x in after if x in before]
-    if not only_in_before and not only_in_after:
+    before_set = frozenset(before)
+    after_set = frozenset(after)
+    only_in_before = [x for x in before if x not in after_set]
+    only_in_after = [x for x in after if x not in before_set]
+    only_in_both = [x for x in after if x in before_set]
+    print_differences(only_in_before, only_in_after, only_in_both)
+
+
+def print_differences(only_in_before, only_in_after, only_in_both):
+    # the arguments are lists of items, or files with one item per line
+    def has_items(items):
+        return items.tell() if hasattr(items, 'tell') else bool(items)
+
+    def print_items(title, items):
+        if hasattr(items, 'seek'):
+            items.seek(0)
+            items = (line.rstrip('\n') for line in items)
+        print(title)
+        for item in items:
+            print('\t' + item)
+    if not has_items(only_in_before) and not has_items(only_in_after):
         print("No differences")
         return
-    if only_in_before:
-        print("Found only in the 'before' commit:")
-        print('\t' + '\n\t'.join(only_in_before))
-    if only_in_after:
-        print("Found only in the 'after' commit:")
-        print('\t' + '\n\t'.join(only_in_after))
-    if only_in_both:
-        print("Found in both the 'before' and 'after' commit:")
-        print('\t' + '\n\t'.join(only_in_both))
+    if has_items(only_in_before):
+        print_items("Found only in the 'before' commit:", only_in_before)
+    if has_items(only_in_after):
+        print_items("Found only in the 'after' commit:", only_in_after)
+    if has_items(only_in_both):
+        print_items(
+            "Found in both the 'before' and 'after' commit:", only_in_both)
+
+
+def read_sorted(path, f):
+    previous = None
+    for line in f:
+        line = line.rstrip('\n')
+        if previous is not None and line < previous:
+            raise SystemExit(
+                "{} isn't sorted, sort it with `LC_ALL=C sort`".format(path))
+        previous = line
+        yield line
+
+
+def compare_sorted_files(before_path, after_path):
+    # merge join of two sorted files, giving the same results as compare_sets
+    # would; the results are spooled to temporary files
+    with contextlib.ExitStack() as stack:
+        before_lines = read_sorted(
+            before_path, stack.enter_context(open(before_path, 'rt')))
+        after_lines = read_sorted(
+            after_path, stack.enter_context(open(after_path, 'rt')))
+        only_in_before, only_in_after, only_in_both = [
+            stack.enter_context(tempfile.TemporaryFile('w+t'))
+            for _ in range(3)]
+        before = next(before_lines, None)
+        after = next(after_lines, None)
+        while before is not None or after is not None:
+            if after is None or before is not None and before < after:
+                only_in_before.write(before + '\n')
+                before = next(before_lines, None)
+            elif before is None or after < before:
+                only_in_after.write(after + '\n')
+                after = next(after_lines, None)
+            else:
+                item = after
+                while after == item:
+                    only_in_both.write(after + '\n')
+                    after = next(after_lines, None)
+                while before == item:
+                    before = next(before_lines, None)
+        print_differences(only_in_before, only_in_after, only_in_both)
 
 
 def get_job_definitions(venv):
-    out = cmd(r'checkbox-cli list all-jobs -f "{id}\n"', venv)
-    return out.decode(sys.stdout.encoding).split('\n')
+    out = checkbox_cli(['list', 'all-jobs', '-f', r'{id}\n'], venv)
+    return out.split('\n')
 
 
 def get_test_plans(venv):
-    out = cmd('checkbox-cli list "test plan"', venv)
+    out = checkbox_cli(['list', 'test plan'], venv)
     test_plans = []
-    for line in out.decode(sys.stdout.encoding).split('\n'):
+    for line in out.split('\n'):
         if line.startswith('test plan'):
             # valid line looks like this:
             # test plan '2000.foo.bar::tp-name'
@@ -162,8 +466,8 @@ def get_test_plans(venv):
 
 
 def list_bootstrapped(venv, tp):
-    out = cmd('checkbox-cli list-bootstrapped {}'.format(tp), venv)
-    return [line for line in out.decode(sys.stdout.encoding).split('\n')]
+    out = checkbox_cli(['list-bootstrapped', tp], venv)
+    return [line for line in out.split('\n')]
 
 
 if __name__ == '__main__':